@@ -13,3 +13,7 @@ class WebsearchItem(scrapy.Item):
     title = scrapy.Field()
     contents = scrapy.Field()
     outlinks = scrapy.Field()
+    # (url, anchor text) of the anchor texts the page gives to the pages it links to
+    anchors = scrapy.Field()
+    # (url, tokens) filled in by the TokenizePipeline
+    tokens = scrapy.Field()
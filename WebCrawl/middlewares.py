@@ -4,10 +4,13 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from politeness import PolitenessScheduler
+
 
 class WebcrawlSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +104,66 @@ class WebcrawlDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class PolitenessMiddleware:
+    """
+    Paces every host with a politeness.PolitenessScheduler instead of a
+    fixed DOWNLOAD_DELAY: each response or download error is recorded, and
+    the host's adapted rate and concurrency become the delay and
+    concurrency of its download slot. The robots.txt responses fetched for
+    ROBOTSTXT_OBEY set the hosts' crawl-delay. The per host throughput is
+    added to the crawl stats and saved to POLITENESS_STATS_FILE when the
+    spider closes.
+    """
+
+    def __init__(self, crawler, scheduler, stats_file):
+        self.crawler = crawler
+        self.scheduler = scheduler
+        self.stats_file = stats_file
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('POLITENESS_ENABLED'):
+            raise NotConfigured
+        scheduler = PolitenessScheduler(rate=settings.getfloat('POLITENESS_START_RATE', 2.0),
+                                        max_rate=settings.getfloat('POLITENESS_MAX_RATE', 16.0),
+                                        concurrency=settings.getint('POLITENESS_START_CONCURRENCY', 2),
+                                        max_concurrency=settings.getint('POLITENESS_MAX_CONCURRENCY', 8),
+                                        target_latency=settings.getfloat('POLITENESS_TARGET_LATENCY', 1.0),
+                                        user_agent=settings.get('USER_AGENT') or '*')
+        s = cls(crawler, scheduler, settings.get('POLITENESS_STATS_FILE'))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        self.scheduler.started(request.url)
+
+    def process_response(self, request, response, spider):
+        if request.url.endswith('/robots.txt') and response.status == 200:
+            self.scheduler.set_robots(request.url, response.body.decode('utf-8', errors='replace'))
+        self.scheduler.record(request.url, request.meta.get('download_latency', 0), response.status,
+                              len(response.body))
+        self.adapt_slot(request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.scheduler.record(request.url, request.meta.get('download_latency', 0), None)
+        self.adapt_slot(request)
+
+    def adapt_slot(self, request):
+        slot = self.crawler.engine.downloader.slots.get(request.meta.get('download_slot'))
+        if slot is None:
+            return
+        policy = self.scheduler.host(request.url)
+        slot.delay = 1 / policy.rate
+        slot.concurrency = max(int(policy.concurrency), 1)
+
+    def spider_closed(self, spider):
+        for host, stats in self.scheduler.stats().items():
+            for name, value in stats.items():
+                if value is not None:
+                    self.crawler.stats.set_value(f'politeness/{host}/{name}', value)
+        if self.stats_file:
+            self.scheduler.save_stats(self.stats_file)
@@ -2,12 +2,109 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+import os
+from array import array
 
+from frontier import UrlTable
+from inverted_index import IndexBuilder
+from link_graph import LinkGraph
+from search_engine import SearchEngine
 
-# useful for handling different item types with a single interface
-from itemadapter import ItemAdapter
 
+def tokenize(text):
+    '''
+    :param text:
+    :return: tokens of text as SearchEngine indexes them
+    '''
+    return SearchEngine.word_tokenize(SearchEngine.clean_text(text))
+
+
+class TokenizePipeline:
+    """
+    Tokenises the body of a page and the anchor texts it gives to the pages
+    it links to, into item['tokens'] = [(url, tokens)]
+    """
 
-class WebcrawlPipeline:
     def process_item(self, item, spider):
+        tokens = [(item['origin_link'], tokenize(item['contents']))]
+        tokens.extend((url, tokenize(text)) for url, text in item['anchors'])
+        item['tokens'] = tokens
         return item
+
+
+class IndexPipeline:
+    """
+    Adds the tokens of every page to an IndexBuilder while the crawl runs,
+    anchor texts to the page they point to, and saves the tf-idf index when
+    the spider closes. It is the index SearchEngine(fresh_start=True)
+    would build from the crawl store. The embeddings of the previous index
+    are removed with it, SearchEngine encodes the new documents in the
+    index's doc id order when it next starts. A resumed crawl first indexes the pages it stored before.
+    Refresh crawls are indexed through their manifest with
+    SearchEngine.apply_manifest instead.
+    """
+
+    def __init__(self, index_dir, embeddings_file):
+        self.index_dir = index_dir
+        self.embeddings_file = embeddings_file
+        self.builder = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('INDEX_DIR', '../../data/tfidf_index'),
+                   crawler.settings.get('EMBEDDINGS_FILE', '../../data/bert_embeddings.h5'))
+
+    def open_spider(self, spider):
+        if spider.refresh:
+            return
+        self.builder = IndexBuilder()
+        for url, text_dict in spider.store.documents():
+            self.builder.add_document(url, tokenize("{} {}".format(text_dict['atext'], text_dict['body'])))
+
+    def process_item(self, item, spider):
+        if self.builder is not None:
+            for url, tokens in item['tokens']:
+                self.builder.add_tokens(url, tokens)
+        return item
+
+    def close_spider(self, spider):
+        if self.builder is not None:
+            self.builder.build().save(self.index_dir)
+            self.builder = None
+            if os.path.exists(self.embeddings_file):
+                os.remove(self.embeddings_file)
+
+
+class LinkGraphPipeline:
+    """
+    Appends the links of every page to int32 arrays of node ids while the
+    crawl runs and saves them as a memory-mappable LinkGraph when the
+    spider closes. The links stored by a resumed or refreshed crawl are
+    loaded first.
+    """
+
+    def __init__(self, link_graph_dir):
+        self.link_graph_dir = link_graph_dir
+        self.urls = UrlTable()
+        self.parents = array('i')
+        self.children = array('i')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('LINK_GRAPH_DIR', '../../data/link_graph'))
+
+    def open_spider(self, spider):
+        for parent, child in spider.store.state.edges:
+            self.add_link(parent, child)
+
+    def add_link(self, parent, child):
+        self.parents.append(self.urls.intern(parent))
+        self.children.append(self.urls.intern(child))
+
+    def process_item(self, item, spider):
+        for child in item['outlinks']:
+            self.add_link(item['origin_link'], child)
+        return item
+
+    def close_spider(self, spider):
+        LinkGraph.from_edges(self.urls.urls, self.parents, self.children).save(self.link_graph_dir)
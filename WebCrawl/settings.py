@@ -27,14 +27,27 @@ CONCURRENT_REQUESTS = 100
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-DOWNLOAD_DELAY = 3
+# Only until the PolitenessMiddleware has seen a host's first response, it then sets the delay from the host's rate
+DOWNLOAD_DELAY = 0.5
 # The download delay setting will honor only one of:
-CONCURRENT_REQUESTS_PER_DOMAIN = 64
-CONCURRENT_REQUESTS_PER_IP = 64
+# upper bound of the concurrency the PolitenessMiddleware adapts per host
+CONCURRENT_REQUESTS_PER_DOMAIN = 8
+# 0 keeps one download slot per host rather than per ip
+CONCURRENT_REQUESTS_PER_IP = 0
 REACTOR_THREADPOOL_MAXSIZE = 20
 LOG_LEVEL = 'INFO'
 RETRY_ENABLED = False
 DOWNLOAD_TIMEOUT = 15
+# Pages whose SimHash fingerprints differ in at most this many bits are near duplicates
+SIMHASH_MAX_DISTANCE = 3
+# Append-only store of the crawl, an interrupted crawl resumes from it
+CRAWL_STORE_DIR = '../../data/crawl'
+# Crawl the stored pages again, requesting only the ones changed since (scrapy crawl uic -s REFRESH_CRAWL=1),
+# and list the changed, added and removed pages in REFRESH_MANIFEST
+REFRESH_CRAWL = False
+REFRESH_MANIFEST = '../../data/manifest.json'
+# Also write data.pickle, link_graph.pickle and url_keys.pickle when the crawl ends, for readers of the old format
+SAVE_PICKLES = False
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED = False
 
@@ -55,9 +68,17 @@ DOWNLOAD_TIMEOUT = 15
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'WebCrawl.middlewares.WebcrawlDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'WebCrawl.middlewares.PolitenessMiddleware': 950,
+}
+# Per host token bucket and concurrency adapted to latency and errors, see politeness.py
+POLITENESS_ENABLED = True
+POLITENESS_START_RATE = 2.0
+POLITENESS_MAX_RATE = 16.0
+POLITENESS_START_CONCURRENCY = 2
+POLITENESS_MAX_CONCURRENCY = 8
+POLITENESS_TARGET_LATENCY = 1.0
+POLITENESS_STATS_FILE = '../../data/politeness_stats.json'
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -67,9 +88,16 @@ DOWNLOAD_TIMEOUT = 15
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'WebCrawl.pipelines.WebcrawlPipeline': 300,
-#}
+# Pages are tokenised and indexed, and their links added to the link graph, while the crawl runs
+ITEM_PIPELINES = {
+    'WebCrawl.pipelines.TokenizePipeline': 300,
+    'WebCrawl.pipelines.IndexPipeline': 400,
+    'WebCrawl.pipelines.LinkGraphPipeline': 500,
+}
+INDEX_DIR = '../../data/tfidf_index'
+# removed when a new index is saved, SearchEngine encodes the pages again
+EMBEDDINGS_FILE = '../../data/bert_embeddings.h5'
+LINK_GRAPH_DIR = '../../data/link_graph'
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -4,14 +4,21 @@ import pickle
 import re
 from urllib.parse import urljoin
 
-import requests
-from bs4 import BeautifulSoup
-from scrapy.exceptions import CloseSpider
+from scrapy import Request, signals
+from scrapy.exceptions import CloseSpider, DontCloseSpider
+from scrapy.http import TextResponse
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
 from tld import get_tld
 from w3lib.url import canonicalize_url
 
+from WebCrawl.items import WebsearchItem
+from crawl_store import CrawlStore
+from extraction import ContentExtractor
+from frontier import EdgeStore
+from near_duplicates import SimHashIndex
+from refresh import GONE_STATUSES, Manifest, conditional_headers, content_hash, response_validators
+
 IGNORED_EXTENSIONS = [
     # images
     '.mng', '.pct', '.bmp', '.gif', '.jpg', '.jpeg', '.png', '.pst', '.psp', '.tif',
@@ -36,40 +43,208 @@ class UICSpyder(CrawlSpider):
     filter_text = open('data_filter.txt', 'r').readlines()
     url_to_content = {}
     url_to_title = {}
+    title_requested = set()
+    duplicates = SimHashIndex()
     url_to_body = {}
-    link_graph = []
+    link_graph = EdgeStore()
     N = 1000
     count = 0
     name = "uic"
     visited_urls = set()
+    refresh = False
     start_urls = ["https://cs.uic.edu/"]
     rules = (Rule(LinkExtractor(allow_domains='uic.edu',
                                 canonicalize=True,
                                 unique=True),
                   callback='parse_item',
-                  follow=True),)
+                  follow=True,
+                  process_request='filter_seen'),)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # links and anchor texts new on the page being parsed, for its item
+        self.page_outlinks = []
+        self.page_anchors = []
+        self.extractor = ContentExtractor(self.filter_text, self.clean_text,
+                                          class_pattern='(title|description|text|quote|course|intro|content)',
+                                          container_tags=('div', 'section', 'span'))
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.duplicates = SimHashIndex(crawler.settings.getint('SIMHASH_MAX_DISTANCE', 3))
+        spider.store = CrawlStore(crawler.settings.get('CRAWL_STORE_DIR', '../../data/crawl'))
+        spider.refresh = crawler.settings.getbool('REFRESH_CRAWL')
+        spider.manifest_file = crawler.settings.get('REFRESH_MANIFEST', '../../data/manifest.json')
+        spider.save_pickles = crawler.settings.getbool('SAVE_PICKLES')
+        spider.restore()
+        crawler.signals.connect(spider.resolve_titles, signal=signals.spider_idle)
+        return spider
+
+    def restore(self):
+        '''
+        Pick up the pages, links, titles and seen urls of an interrupted crawl
+        from the store
+        :return:
+        '''
+        state = self.store.state
+        self.url_to_content, self.url_to_body, self.url_to_title, self.url_to_md5 = {}, {}, {}, {}
+        self.link_graph = EdgeStore()
+        for url, document in state.documents.items():
+            if document['anchors']:
+                self.url_to_content[url] = set(document['anchors'])
+            # pages kept by parse_item, unlike start urls and near duplicates, have a fingerprint
+            if url in state.fingerprints:
+                self.url_to_body[url] = document['body']
+                self.url_to_md5[url] = self.txt_md5(url)
+            if document['title'] is not None:
+                self.url_to_title[url] = document['title']
+        for parent, child in state.edges:
+            for url in [parent, child]:
+                if url not in self.url_to_md5:
+                    self.url_to_md5[url] = self.txt_md5(url)
+            self.link_graph.add((self.url_to_md5[parent], self.url_to_md5[child]))
+        for url, fingerprint in state.fingerprints.items():
+            self.duplicates.add(url, fingerprint)
+        self.visited_urls = set(state.crawled)
+        self.count = len(self.url_to_body)
+        self.crawled = len(self.url_to_content)
+        if self.refresh:
+            # a refresh crawls the site again from start_urls, the stored pages are its previous crawl
+            self.manifest = Manifest(self.url_to_body)
+            self.requested = set()
+            self.visited_urls = set()
+            self.count = 0
+
+    def start_requests(self):
+        '''
+        A new crawl starts from start_urls, a resumed one from the urls it
+        had queued but not crawled. A refresh starts from start_urls again.
+        '''
+        if self.refresh:
+            for url in self.start_urls:
+                self.requested.add(url)
+                yield Request(url, dont_filter=True)
+            return
+        if not self.store.state.crawled:
+            for url in self.start_urls:
+                self.store.add_queued(url)
+                yield Request(url, dont_filter=True)
+            return
+        for url in self.store.state.frontier():
+            yield Request(url, meta={'resumed': True})
+
+    async def start(self):
+        # Scrapy 2.13 and later ask start() rather than start_requests()
+        for request in self.start_requests():
+            yield request
+
+    def parse_start_url(self, response):
+        if response.meta.get('resumed'):
+            return self.parse_item(response) or []
+        self.store.add_crawled(response.request.url)
+        return []
+
+    def filter_seen(self, request, response):
+        '''
+        Drop requests for urls queued before, in this crawl or the one it resumes
+        '''
+        if self.refresh:
+            if request.url in self.requested:
+                return None
+            self.requested.add(request.url)
+            return self.conditional(request)
+        if self.store.state.seen(request.url):
+            return None
+        self.store.add_queued(request.url)
+        return request
+
+    def conditional(self, request):
+        '''
+        Ask for the page only if it changed since it was stored, and let
+        304 Not Modified and the statuses of removed pages reach parse_item
+        '''
+        request.headers.update(conditional_headers(self.store.state.validators.get(request.url)))
+        request.meta['handle_httpstatus_list'] = [304] + sorted(GONE_STATUSES)
+        return request
+
+    def unchanged(self, url, response):
+        validators = self.store.state.validators.get(url)
+        if validators is None or url not in self.url_to_body:
+            return False
+        return response.status == 304 or content_hash(response.body) == validators['hash']
+
+    def follow_stored_links(self, url, response):
+        '''
+        A 304 response has no links for the rules to follow, the stored
+        links to pages the rules let through before are requested instead
+        '''
+        if response.status != 304:
+            return []
+        state = self.store.state
+        requests = (self.filter_seen(Request(child, meta={'resumed': True}), response)
+                    for child in state.links.get(url, []) if child in state.crawled)
+        return [request for request in requests if request is not None]
 
     def parse_item(self, response):
         url = response.request.url
-        html = requests.get(url).text
         print(f"Crawling {self.count}: {url}")
         self.visited_urls.add(url)
         if self.count >= self.N:
             raise CloseSpider(f"Crawled {self.count} pages. Exiting.")
+        if self.refresh:
+            if response.status in GONE_STATUSES:
+                self.remove(url)
+                return []
+            if self.unchanged(url, response):
+                self.manifest.unchanged(url)
+                self.count += 1
+                return self.follow_stored_links(url, response)
+        page = self.extractor.parse(response.text)
+        body = self.extractor.body(page)
+        fingerprint = self.duplicates.fingerprint(self.extractor.fingerprint_text(page, body))
+        original = self.duplicates.find(fingerprint)
+        for redirected in response.meta.get('redirect_urls', []):
+            self.store.add_crawled(redirected)
+        # a changed page is not a duplicate of its own previous version
+        if original is not None and original != url:
+            print(f"Near duplicate of {original}: {url}")
+            self.store.add_crawled(url)
+            if self.refresh:
+                self.remove(url)
+            return
+        self.duplicates.add(url, fingerprint)
         self.count += 1
         self.url_to_md5[url] = self.txt_md5(url)
-        self.url_to_title[url] = self.get_title(url)
-        self.add_body(url, html)
-        self.get_linked_urls(url, html)
+        self.url_to_title[url] = self.get_title(page)
+        self.url_to_body[url] = body
+        self.store.add_page(url, self.url_to_title[url], self.url_to_body[url], fingerprint)
+        headers = {name: response.headers.get(name).decode('latin-1')
+                   for name in ['ETag', 'Last-Modified'] if response.headers.get(name)}
+        self.store.add_validators(url, response_validators(headers, response.body))
+        if self.refresh:
+            self.manifest.updated(url)
+        self.page_outlinks, self.page_anchors = [], []
+        self.get_linked_urls(url, page)
         print("*" * 30)
         if len(self.url_to_content) > self.crawled + 100:
             self.crawled = len(self.url_to_content)
-            self.save_data()
+            self.store.flush()
+        return [WebsearchItem(origin_link=url, title=self.url_to_title[url], contents=self.url_to_body[url],
+                              outlinks=self.page_outlinks, anchors=self.page_anchors)]
 
-    def get_linked_urls(self, url, html):
-        soup = BeautifulSoup(html, 'html.parser')
-        for link in soup.find_all('a'):
-            path = link.get('href')
+    def remove(self, url):
+        '''
+        A page of the previous crawl that is gone, or now a near duplicate
+        '''
+        self.manifest.gone(url)
+        if url in self.url_to_body:
+            self.url_to_body.pop(url)
+            self.store.delete_document(url)
+
+    def get_linked_urls(self, url, page):
+        for link in page.links:
+            path = link.href
             if path and path.startswith('/'):
                 path = urljoin(url, path)
             try:
@@ -80,46 +255,11 @@ class UICSpyder(CrawlSpider):
                 continue
             if self.a_file(path) or "uic.edu" not in domain:
                 continue
-            self.add_content(path, link.getText())
+            self.add_content(path, link.text)
             self.add_link(url, path)
 
-    def add_body(self, url, html):
-        url_text = set()
-        soup = BeautifulSoup(html, 'html.parser')
-        regex = re.compile('(title|description|text|quote|course|intro|content)')
-        htags = ["h1", "h2", "h3"]
-        for tag in htags:
-            for heading in soup.find_all(tag, {"class": regex}):
-                heading = heading.getText()
-                heading = self.clean_text(heading.lower())
-                url_text.add(heading)
-        for tag in ['div', 'section', 'span']:
-            for EachPart in soup.find_all(tag, {"class": regex}):
-                for text in EachPart.find_all(["h1", "h2", "h3", 'title', 'p']):
-                    text = text.getText()
-                    text = self.clean_text(text.lower())
-                    url_text.add(text)
-                text = EachPart.getText()
-                text = self.clean_text(text.lower())
-                url_text.add(text)
-
-        for text in soup.find_all(['p']):
-            text = text.getText()
-            text = self.clean_text(text.lower())
-            url_text.add(text)
-        page_body = []
-        for utext in url_text:
-            addtext = True
-            for ftext in self.filter_text:
-                ftext = self.clean_text(ftext)
-                if ftext in utext or utext in ftext:
-                    if len(utext.split()) < 20:
-                        addtext = False
-                if ftext == utext or re.match(r'skip\sto\s.*content', utext):
-                    addtext = False
-            if addtext:
-                page_body += [utext]
-        self.url_to_body[url] = " . ".join(page_body)
+    def add_body(self, url, page):
+        self.url_to_body[url] = self.extractor.body(page)
 
     def add_link(self, parent, child):
         if parent in self.url_to_md5:
@@ -132,8 +272,9 @@ class UICSpyder(CrawlSpider):
         else:
             child_key = self.txt_md5(child)
             self.url_to_md5[child] = child_key
-        if (parent_key, child_key) not in self.link_graph:
-            self.link_graph.append((parent_key, child_key))
+        if self.link_graph.add((parent_key, child_key)):
+            self.store.add_edge(parent, child)
+            self.page_outlinks.append(child)
 
     def txt_md5(self, txt):
         txt = txt.encode('utf-8')
@@ -152,16 +293,11 @@ class UICSpyder(CrawlSpider):
             self.url_to_content[url] = set()
         if content in self.url_to_content[url]:
             return
-        addtext = True
-        for ftext in self.filter_text:
-            ftext = self.clean_text(ftext)
-            if ftext in content or content in ftext:
-                addtext = False
-        if not addtext:
+        if not self.extractor.keep_anchor(content):
             return
-        if url not in self.url_to_title:
-            self.url_to_title[url] = self.get_title(url)
         self.url_to_content[url].add(content)
+        self.store.add_anchor(url, content)
+        self.page_anchors.append((url, content))
 
     def clean_text(self, text: str):
         text = re.sub(r"[^a-zA-Z0-9 -,.&\"%$@()]", " ", text)
@@ -187,9 +323,18 @@ class UICSpyder(CrawlSpider):
                          "title": title}
         return collections.OrderedDict(data)
 
+    def closed(self, reason):
+        self.store.close()
+        if self.save_pickles:
+            self.save_data()
+        if self.refresh:
+            # pages of the previous crawl are only known to be removed if the crawl was not cut short
+            self.manifest.finish(reason == 'finished')
+            self.manifest.save(self.manifest_file)
+
     def save_data(self):
         with open('../../data/link_graph.pickle', 'wb') as fptr:
-            pickle.dump(self.link_graph, fptr)
+            pickle.dump(list(self.link_graph), fptr)
             fptr.close()
         with open('../../data/data.pickle', 'wb') as fptr:
             pickle.dump(self.get_data(), fptr)
@@ -198,9 +343,39 @@ class UICSpyder(CrawlSpider):
             pickle.dump(collections.OrderedDict(self.url_to_md5), fptr)
             fptr.close()
 
-    def get_title(self, url):
-        html = requests.get(url).text
-        soup = BeautifulSoup(html, 'html.parser')
-        title = str(soup.title.string)
-        title = re.sub("\s+", " ", title).strip()
+    def get_title(self, page):
+        if page.title is None:
+            return ""
+        title = page.title
+        title = re.sub(r"\s+", " ", title).strip()
         return title
+
+    def resolve_titles(self):
+        '''
+        Outlinks get their title when their own response is parsed. Those
+        the rules did not crawl are requested once the spider is idle, only
+        to read their title.
+        :return:
+        '''
+        pending = [url for url in self.url_to_content
+                   if url not in self.url_to_title and url not in self.title_requested]
+        if not pending:
+            return
+        for url in pending:
+            self.title_requested.add(url)
+            request = Request(url, callback=self.parse_title, dont_filter=True)
+            try:
+                self.crawler.engine.crawl(request)
+            except TypeError:
+                # Scrapy < 2.6 also takes the spider
+                self.crawler.engine.crawl(request, self)
+        raise DontCloseSpider
+
+    def parse_title(self, response):
+        url = response.request.url
+        if isinstance(response, TextResponse):
+            self.url_to_title[url] = self.get_title(self.extractor.parse(response.text))
+        else:
+            # a pdf or image behind an extensionless url has no title
+            self.url_to_title[url] = ""
+        self.store.add_title(url, self.url_to_title[url])
@@ -0,0 +1,193 @@
+import h5py
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+def top_k(distances, k):
+    '''
+    Positions of the k smallest distances in ascending order
+    :param distances:
+    :param k:
+    :return:
+    '''
+    k = min(k, len(distances))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    nearest = np.argpartition(distances, k - 1)[:k]
+    return nearest[np.argsort(distances[nearest], kind='stable')]
+
+
+def unit_rows(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+class ExactIndex:
+    """
+    Brute force search over every document embedding
+    """
+    name = 'exact'
+
+    def __init__(self):
+        self.embeddings = None
+
+    def build(self, embeddings):
+        self.embeddings = embeddings
+
+    def update(self, embeddings, doc_ids):
+        self.embeddings = embeddings
+
+    def search(self, query, k, metric='cosine'):
+        distances = cdist([query], self.embeddings, metric)[0]
+        doc_ids = top_k(distances, k)
+        return doc_ids, distances[doc_ids]
+
+    def search_many(self, queries, k, metric='cosine', block_size=256):
+        '''
+        Search a batch of queries. Cosine and euclidean distances are computed
+        with one matrix product per block of queries.
+        :param queries: (num_queries x dim) array
+        :param k:
+        :param metric:
+        :param block_size: number of queries whose distances are held in memory at once
+        :return: list of (doc_ids, distances) per query
+        '''
+        results = []
+        for start in range(0, len(queries), block_size):
+            distances = self.distances(np.asarray(queries[start:start + block_size]), metric)
+            for row in distances:
+                doc_ids = top_k(row, k)
+                results.append((doc_ids, row[doc_ids]))
+        return results
+
+    def distances(self, queries, metric):
+        if metric == 'cosine':
+            return 1 - unit_rows(queries).dot(unit_rows(self.embeddings).T)
+        if metric in ('euclidean', 'sqeuclidean'):
+            squared = (np.sum(queries ** 2, axis=1)[:, None] + np.sum(self.embeddings ** 2, axis=1)[None, :]
+                       - 2 * queries.dot(self.embeddings.T))
+            squared = np.maximum(squared, 0)
+            return squared if metric == 'sqeuclidean' else np.sqrt(squared)
+        return cdist(queries, self.embeddings, metric)
+
+    def save(self, path):
+        pass
+
+    def load(self, path, embeddings):
+        self.embeddings = embeddings
+        return self
+
+
+class IVFIndex:
+    """
+    Inverted file index: the embeddings are clustered with spherical k-means
+    and a query is only compared against the documents of the n_probe
+    clusters whose centroids are closest to it. n_probe trades recall for
+    latency, n_probe == n_lists is an exact search.
+    """
+    name = 'ivf'
+
+    def __init__(self, n_lists=None, n_probe=8, num_iterations=10, seed=0):
+        self.embeddings = None
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.num_iterations = num_iterations
+        self.seed = seed
+        self.centroids = None
+        self.list_offsets = None
+        self.list_ids = None
+        self.assignments = None
+
+    def build(self, embeddings):
+        self.embeddings = embeddings
+        vectors = unit_rows(np.asarray(embeddings, dtype=np.float32))
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        rng = np.random.default_rng(self.seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(self.num_iterations):
+            assignments = self.assign(vectors, centroids)
+            for list_id in range(n_lists):
+                members = vectors[assignments == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = unit_rows(centroids)
+        self.centroids = centroids
+        self.n_lists = n_lists
+        self.set_lists(self.assign(vectors, centroids))
+
+    @staticmethod
+    def assign(vectors, centroids, block_size=4096):
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_size):
+            similarities = vectors[start:start + block_size].dot(centroids.T)
+            assignments[start:start + block_size] = np.argmax(similarities, axis=1)
+        return assignments
+
+    def update(self, embeddings, doc_ids):
+        '''
+        Assign new or changed embeddings to their closest list, the centroids
+        are kept until the next build
+        :param embeddings: all embeddings, new documents appended
+        :param doc_ids: rows that changed
+        :return:
+        '''
+        self.embeddings = embeddings
+        assignments = np.zeros(len(embeddings), dtype=np.int32)
+        assignments[:len(self.assignments)] = self.assignments
+        vectors = unit_rows(np.asarray(embeddings[doc_ids], dtype=np.float32))
+        assignments[doc_ids] = self.assign(vectors, self.centroids)
+        self.set_lists(assignments)
+
+    def set_lists(self, assignments):
+        self.assignments = assignments
+        self.list_ids = np.argsort(assignments, kind='stable').astype(np.int32)
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def candidates(self, query, n_probe):
+        query = query / (np.linalg.norm(query) or 1)
+        similarities = self.centroids.dot(query)
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(-similarities, n_probe - 1)[:n_probe]
+        return np.concatenate([self.list_ids[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes])
+
+    def search(self, query, k, metric='cosine'):
+        n_probe = self.n_probe
+        doc_ids = self.candidates(query, n_probe)
+        # widen the probe until there are enough candidates to fill k results
+        while len(doc_ids) < min(k, len(self.embeddings)) and n_probe < self.n_lists:
+            n_probe *= 2
+            doc_ids = self.candidates(query, n_probe)
+        doc_ids = np.sort(doc_ids)
+        distances = cdist([query], self.embeddings[doc_ids], metric)[0]
+        nearest = top_k(distances, k)
+        return doc_ids[nearest], distances[nearest]
+
+    def search_many(self, queries, k, metric='cosine'):
+        return [self.search(query, k, metric) for query in queries]
+
+    def save(self, path):
+        h5f1 = h5py.File(path, 'w')
+        h5f1.create_dataset('centroids', data=self.centroids)
+        h5f1.create_dataset('list_offsets', data=self.list_offsets)
+        h5f1.create_dataset('list_ids', data=self.list_ids)
+        h5f1.close()
+
+    def load(self, path, embeddings):
+        h5f1 = h5py.File(path, 'r')
+        self.centroids = h5f1['centroids'][:]
+        self.list_offsets = h5f1['list_offsets'][:]
+        self.list_ids = h5f1['list_ids'][:]
+        h5f1.close()
+        self.n_lists = len(self.centroids)
+        self.assignments = np.empty(len(self.list_ids), dtype=np.int32)
+        self.assignments[self.list_ids] = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        if self.list_offsets[-1] != len(embeddings):
+            raise ValueError(f"{path} indexes {self.list_offsets[-1]} documents, expected {len(embeddings)}")
+        self.embeddings = embeddings
+        return self
+
+
+ANN_INDEXES = {index.name: index for index in [ExactIndex, IVFIndex]}
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+from crawler import MAX_FILE_SIZE, Crawler
+from refresh import GONE_STATUSES, conditional_headers
+
+
+class AsyncCrawler(Crawler):
+    """
+    Crawler that fetches pages concurrently with asyncio over a pooled
+    aiohttp session.
+
+    Every page is downloaded once: the fingerprint of its head and body,
+    which Crawler.is_unique gets by fetching each discovered link a second
+    time, is computed from the same response whose links are followed. A
+    discovered link is only recorded (anchor text and link graph edge) once
+    its page was fetched and found unique, as in Crawler. The links of the
+    first max_pages unique pages are followed. Workers take the next page
+    from the shared frontier, so its strategy orders the crawl. The outputs
+    are the same as Crawler.run, and refresh crawls work the same way.
+    Requests to a host are paced by the politeness scheduler, concurrency
+    and per_host only bound the connection pool.
+    """
+
+    def __init__(self, urls=[], max_pages=5000, concurrency=32, per_host=8, timeout=30, allowed_domain=None,
+                 max_distance=3, strategy=None, refresh=False, politeness=None):
+        '''
+        :param urls: seed urls
+        :param max_pages: number of pages whose links are followed
+        :param concurrency: number of simultaneous requests
+        :param per_host: number of simultaneous requests to one host
+        :param timeout: seconds allowed for one request
+        :param allowed_domain: links outside this domain are ignored, uic.edu by default
+        :param max_distance: see Crawler
+        :param strategy: see Crawler
+        :param refresh: see Crawler
+        :param politeness: see Crawler
+        '''
+        super().__init__(urls, max_pages, max_distance, strategy, refresh, politeness)
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        if allowed_domain is not None:
+            self.allowed_domain = allowed_domain
+        self.num_crawled = 0
+        self.num_active = 0
+        # (parent, anchor contents) of the queued pages
+        self.discovered = {}
+        # host: task reading its robots.txt
+        self.robots = {}
+
+    async def read_robots(self, session, url):
+        robots_url = self.politeness.needs_robots(url)
+        if robots_url is None:
+            return
+        try:
+            async with session.get(robots_url) as response:
+                text = await response.text() if response.status == 200 else ""
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            text = ""
+        self.politeness.set_robots(url, text)
+
+    async def fetch_robots(self, session, url):
+        '''
+        The first request to a host reads its robots.txt, the others wait for it
+        '''
+        host = urlparse(url).netloc
+        if host not in self.robots:
+            self.robots[host] = asyncio.ensure_future(self.read_robots(session, url))
+        await self.robots[host]
+
+    async def fetch(self, session, url):
+        '''
+        :return: (status, headers, content, html) of the response, html is None if the page did not change
+        '''
+        await self.fetch_robots(session, url)
+        await self.politeness.wait_async(url)
+        start = time.monotonic()
+        status, content = None, b""
+        try:
+            async with session.get(url, headers=conditional_headers(self.previous.get(url))) as response:
+                status = response.status
+                content = await response.content.read(MAX_FILE_SIZE)
+                if self.unchanged(url, response.status, content) is not None:
+                    return response.status, response.headers, content, None
+                return response.status, response.headers, content, content.decode(response.charset or 'utf-8',
+                                                                                  errors='replace')
+        finally:
+            self.politeness.release(url, time.monotonic() - start, status, len(content))
+
+    async def process(self, session, url):
+        parent, contents = self.discovered.pop(url, (None, None))
+        try:
+            status, headers, content, html = await self.fetch(session, url)
+            if self.manifest is not None and status in GONE_STATUSES:
+                self.manifest.gone(url)
+                return
+            if html is None:
+                # unchanged since the refreshed crawl, its links and fingerprint are reused
+                stored = self.previous[url]
+                page, fingerprint = None, stored.get('fingerprint')
+            else:
+                page = self.extractor.parse(html)
+                fingerprint = self.page_fingerprint(page)
+        except Exception:
+            logging.info(f'Failed to fetch: {url}')
+            return
+        if fingerprint is not None:
+            # a seed crawled by Crawler has no fingerprint to reuse
+            self.fingerprints[url] = fingerprint
+        if parent is not None:
+            if fingerprint is not None and self.duplicates.find(fingerprint) is not None:
+                return
+            self.all_urls.append(url)
+            self.add_content(url, parent, contents)
+            self.add_link(parent, url)
+        if fingerprint is not None:
+            self.duplicates.add(url, fingerprint)
+        if self.num_crawled >= self.max_pages:
+            return
+        logging.info(f'{self.num_crawled}) Crawling: {url}')
+        self.num_crawled += 1
+        self.visited_urls.add(url)
+        if page is None:
+            self.pages[url] = stored
+            self.manifest.unchanged(url)
+            links = stored['links']
+        else:
+            links = list(self.linked_urls(url, page))
+            self.record_page(url, headers, content, links, page)
+        for path, contents in links:
+            if not path or self.a_file(path) or self.allowed_domain not in urlparse(path).netloc:
+                continue
+            if self.frontier.add(path, parent=url):
+                self.discovered[path] = (url, contents)
+
+    async def worker(self, session, changed):
+        while True:
+            async with changed:
+                # done once nothing is queued and no page in flight can queue more
+                await changed.wait_for(lambda: self.frontier or not self.num_active)
+                if not self.frontier:
+                    return
+                url = self.frontier.pop()
+                self.num_active += 1
+            try:
+                await self.process(session, url)
+            except Exception:
+                logging.exception(f'Failed to crawl: {url}')
+            finally:
+                async with changed:
+                    self.num_active -= 1
+                    changed.notify_all()
+
+    async def crawl_all(self):
+        changed = asyncio.Condition()
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[self.worker(session, changed) for _ in range(self.concurrency)])
+
+    def run(self):
+        asyncio.run(self.crawl_all())
+        self.complete = self.num_crawled < self.max_pages
+        self.save()
+
+
+def main():
+    AsyncCrawler(urls=['https://cs.uic.edu/'], max_pages=100).run()
+
+
+if __name__ == '__main__':
+    main()
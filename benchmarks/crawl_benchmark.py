@@ -0,0 +1,447 @@
+"""
+Crawls a synthetic uic.edu-like site served from a local HTTP server, to
+track the throughput of crawler.py and of the Scrapy spider without hitting
+the real uic.edu.
+
+    python benchmarks/crawl_benchmark.py [--pages 300] [--fanout 8] [--duplicates 0.1]
+        [--slow 0.1] [--slow-delay 0.5] [--failing 0.05] [--max-pages N]
+        [--crawlers crawler,spider,parallel] [--workers N] [--no-politeness] [--no-pipelines]
+
+parallel is parallel_crawl.py with --workers processes (one per core by
+default), whose peak RSS is the sum of the peaks of its processes.
+
+The site is generated from a seed: pages in news, courses, people, research
+and events sections, each with the header, navigation and social media
+boilerplate of data_filter.txt, fanout links to other pages and a share of
+pages that repeat another page under a new url. Some pages live on a slow
+host, which answers after slow-delay seconds, or on a failing host, which
+answers 503. The hosts are made-up subdomains of uic.edu so the crawlers
+keep their domain filters: each crawler runs in its own process, in a
+scratch directory, with the local server as its HTTP proxy.
+
+For each crawler it reports pages per second, bytes fetched, duplicate
+fetches (requests for a url fetched before, and fetches of pages that
+duplicate another one), peak RSS and extraction time per page.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HOST = 'synthetic.uic.edu'
+SLOW_HOST = 'slow.synthetic.uic.edu'
+FAILING_HOST = 'failing.synthetic.uic.edu'
+SECTIONS = ['news', 'courses', 'people', 'research', 'events']
+WORDS = ("computer science students faculty research graduate undergraduate program course lecture engineering "
+         "chicago campus seminar award laboratory systems data learning security theory department advising "
+         "admission degree project robotics networks algorithms scholarship internship alumni colloquium").split()
+BOILERPLATE = """
+<a href="#main-content">Skip to main content</a>
+<nav class="menu">
+  <a href="{home}">Home page</a> <a href="{home}">About</a> <a href="{home}">Quick Links</a>
+  <a href="{home}">Site Search</a> <ul class="breadcrumb"><li><a href="{home}">UIC</a></li><li>{section}</li></ul>
+</nav>
+"""
+FOOTER = """
+<footer>
+  <h2>Social Media</h2>
+  <a href="https://facebook.com/uic">Facebook</a> <a href="https://twitter.com/uic">Twitter</a>
+  <a href="https://linkedin.com/school/uic">Linked In</a>
+  <h2>Edu Links</h2>
+  <p>Tools and resources for Chrome, Firefox, Safari, Edge and IE11.</p>
+</footer>
+"""
+
+
+class SyntheticSite:
+    """
+    Pages of a uic.edu-like site, {url: html}
+    """
+
+    def __init__(self, pages=300, fanout=8, duplicates=0.1, slow=0.1, failing=0.05, seed=0):
+        '''
+        :param pages: number of pages
+        :param fanout: links of every page to other pages of the site
+        :param duplicates: share of pages repeating the content of another page
+        :param slow: share of pages on the slow host
+        :param failing: share of pages on the failing host
+        :param seed:
+        '''
+        rng = random.Random(seed)
+        self.urls = [f"http://{HOST}/"]
+        for number in range(1, pages):
+            roll = rng.random()
+            host = SLOW_HOST if roll < slow else FAILING_HOST if roll < slow + failing else HOST
+            self.urls.append(f"http://{host}/{SECTIONS[number % len(SECTIONS)]}/{number}")
+        # duplicate url: url of the page whose content it repeats, on the same host for its relative links
+        self.duplicate_of = {}
+        for number in range(2, pages):
+            if rng.random() < duplicates:
+                host = urlsplit(self.urls[number]).netloc
+                originals = [url for url in self.urls[1:number] if urlsplit(url).netloc == host]
+                if originals:
+                    self.duplicate_of[self.urls[number]] = rng.choice(originals)
+        self.pages = {}
+        for number, url in enumerate(self.urls):
+            original = self.duplicate_of.get(url)
+            if original is not None:
+                self.pages[url] = self.pages[original]
+                continue
+            # every page links to the next one, so the whole site is reachable from the home page
+            targets = [self.urls[(number + 1) % pages]] + rng.sample(self.urls, min(fanout - 1, pages))
+            self.pages[url] = self.page(rng, url, targets)
+
+    @staticmethod
+    def page(rng, url, targets):
+        host, section = urlsplit(url).netloc, urlsplit(url).path.split('/')[1] or 'home'
+
+        def words(count):
+            return " ".join(rng.choice(WORDS) for _ in range(count))
+
+        links = []
+        for target in targets:
+            parts = urlsplit(target)
+            # links within a host are relative, as on uic.edu
+            href = parts.path if parts.netloc == host else target
+            links.append(f'<li><a href="{href}">{words(3).title()}</a></li>')
+        paragraphs = "".join(f'<p class="description">{words(40)}.</p>' for _ in range(3))
+        title = words(4).title()
+        return (f"<!DOCTYPE html><html><head><title>{title} | UIC</title></head><body>"
+                f"{BOILERPLATE.format(home=f'http://{HOST}/', section=section)}"
+                f'<div class="content"><h1 class="title">{title}</h1>{paragraphs}'
+                f'<ul class="related">{"".join(links)}</ul></div>'
+                f"{FOOTER}</body></html>").encode('utf-8')
+
+
+class SiteServer(ThreadingHTTPServer):
+    """
+    Serves a SyntheticSite to crawlers using it as their HTTP proxy, and
+    counts what they fetch
+    """
+    daemon_threads = True
+
+    def __init__(self, site, slow_delay):
+        super().__init__(('127.0.0.1', 0), SiteHandler)
+        self.site = site
+        self.slow_delay = slow_delay
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.fetches = Counter()
+            self.served = set()
+            self.statuses = Counter()
+            self.bytes = 0
+
+    def record(self, url, status, size):
+        with self.lock:
+            if not url.endswith('/robots.txt'):
+                self.fetches[url] += 1
+                if status == 200:
+                    self.served.add(url)
+            self.statuses[status] += 1
+            self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {'pages': len(self.served),
+                    'requests': sum(self.fetches.values()),
+                    'bytes': self.bytes,
+                    'refetches': sum(count - 1 for count in self.fetches.values()),
+                    'duplicate_pages': sum(1 for url in self.served if url in self.site.duplicate_of),
+                    'statuses': {str(status): count for status, count in sorted(self.statuses.items())}}
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        # a proxied request names the whole url, a direct one only its path
+        parts = urlsplit(self.path)
+        host = parts.netloc or self.headers.get('Host', HOST)
+        url = f"http://{host}{parts.path or '/'}"
+        if parts.path == '/robots.txt':
+            status, body = 200, b"User-agent: *\nDisallow: /private/\n"
+        elif host == FAILING_HOST:
+            status, body = 503, b"Service Unavailable"
+        elif url in self.server.site.pages:
+            if host == SLOW_HOST:
+                time.sleep(self.server.slow_delay)
+            status, body = 200, self.server.site.pages[url]
+        else:
+            status, body = 404, b"Not Found"
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(url, status, len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TimedExtractor:
+    """
+    ContentExtractor that adds up the time spent parsing pages and
+    extracting their body
+    """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.seconds = 0.0
+        self.pages = 0
+
+    def __getattr__(self, name):
+        return getattr(self.extractor, name)
+
+    def parse(self, html):
+        start = time.perf_counter()
+        page = self.extractor.parse(html)
+        self.seconds += time.perf_counter() - start
+        self.pages += 1
+        return page
+
+    def body(self, page):
+        start = time.perf_counter()
+        body = self.extractor.body(page)
+        self.seconds += time.perf_counter() - start
+        return body
+
+
+def unthrottled():
+    from politeness import PolitenessScheduler
+    return PolitenessScheduler(rate=1e9, max_rate=1e9, burst=1e9, concurrency=1e9, max_concurrency=1e9)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timings(seconds, extractor):
+    return {'seconds': seconds, 'parsed': extractor.pages, 'extraction_seconds': extractor.seconds,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run_crawler(options):
+    '''
+    Crawl with crawler.Crawler, from the scratch directory
+    :return: timings
+    '''
+    from crawler import Crawler
+    logging.getLogger().setLevel(logging.WARNING)
+    crawler = Crawler(urls=[options.seed], max_pages=options.max_pages,
+                      politeness=None if options.politeness else unthrottled())
+    crawler.extractor = TimedExtractor(crawler.extractor)
+    start = time.perf_counter()
+    crawler.run()
+    return timings(time.perf_counter() - start, crawler.extractor)
+
+
+def run_spider(options):
+    '''
+    Crawl with the Scrapy spider, from WebCrawl/spiders in the scratch directory
+    :return: timings
+    '''
+    from scrapy.crawler import CrawlerProcess
+    from WebCrawl import settings as project_settings
+    from WebCrawl.spiders.uic_spyder import UICSpyder
+
+    class BenchmarkSpider(UICSpyder):
+        name = 'uic_benchmark'
+        N = options.max_pages
+        start_urls = [options.seed]
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.extractor = TimedExtractor(self.extractor)
+
+    settings = {name: getattr(project_settings, name) for name in dir(project_settings) if name.isupper()}
+    settings['LOG_LEVEL'] = 'WARNING'
+    if not options.politeness:
+        settings.update(POLITENESS_ENABLED=False, DOWNLOAD_DELAY=0, CONCURRENT_REQUESTS_PER_DOMAIN=100)
+    if not options.pipelines:
+        settings['ITEM_PIPELINES'] = {}
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(BenchmarkSpider)
+    process.crawl(crawler)
+    start = time.perf_counter()
+    process.start()
+    return timings(time.perf_counter() - start, crawler.spider.extractor)
+
+
+def run_parallel_worker(worker, frontier_file, shard_dir, options, result):
+    from parallel_crawl import CrawlWorker
+    from politeness import PolitenessScheduler
+    logging.getLogger().setLevel(logging.WARNING)
+    # as parallel_crawl.crawl, the workers share the rate of a host
+    politeness = (PolitenessScheduler(workers=options.workers)
+                  if options.politeness else unthrottled())
+    crawl_worker = CrawlWorker(worker, frontier_file, shard_dir, options.max_pages, politeness=politeness)
+    crawl_worker.extractor = TimedExtractor(crawl_worker.extractor)
+    crawl_worker.run()
+    with open(result, 'w') as fptr:
+        json.dump(timings(0, crawl_worker.extractor), fptr)
+
+
+def run_parallel(options):
+    '''
+    Crawl with parallel_crawl.py, from the scratch directory
+    :return: timings, extraction and peak RSS added up over the processes
+    '''
+    import multiprocessing
+    from parallel_crawl import SharedFrontier, merge_shards
+    frontier_file, shard_dir = os.path.join('data', 'frontier.sqlite'), os.path.join('data', 'shards')
+    start = time.perf_counter()
+    frontier = SharedFrontier(frontier_file, options.max_pages)
+    frontier.add([options.seed])
+    frontier.close()
+    results = [f"worker-{worker}.json" for worker in range(options.workers)]
+    processes = [multiprocessing.Process(target=run_parallel_worker,
+                                         args=(worker, frontier_file, shard_dir, options, result))
+                 for worker, result in enumerate(results)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    merge_shards(shard_dir)
+    seconds = time.perf_counter() - start
+    stats = {'seconds': seconds, 'parsed': 0, 'extraction_seconds': 0, 'peak_rss_mb': peak_rss_mb()}
+    for result in results:
+        with open(result) as fptr:
+            worker_stats = json.load(fptr)
+        for key in ['parsed', 'extraction_seconds', 'peak_rss_mb']:
+            stats[key] += worker_stats[key]
+    return stats
+
+
+RUNNERS = {'crawler': run_crawler, 'spider': run_spider, 'parallel': run_parallel}
+
+
+def scratch_directory():
+    '''
+    :return: a directory laid out like the repository, with the filter files and an empty data/
+    '''
+    directory = tempfile.mkdtemp(prefix='crawl_benchmark_')
+    os.makedirs(os.path.join(directory, 'data'))
+    os.makedirs(os.path.join(directory, 'WebCrawl', 'spiders'))
+    for name in ['data_filter.txt', os.path.join('WebCrawl', 'spiders', 'data_filter.txt')]:
+        shutil.copy(os.path.join(ROOT, name), os.path.join(directory, name))
+    return directory
+
+
+def child(options):
+    '''
+    Run one crawler and write its timings and peak RSS to options.result
+    '''
+    os.chdir(os.path.join(options.directory, 'WebCrawl', 'spiders') if options.run == 'spider'
+             else options.directory)
+    stats = RUNNERS[options.run](options)
+    with open(options.result, 'w') as fptr:
+        json.dump(stats, fptr)
+
+
+def benchmark(name, options, server):
+    '''
+    Run one crawler in its own process against the server
+    :return: the child's results and the server's counts
+    '''
+    directory = scratch_directory()
+    result = os.path.join(directory, 'result.json')
+    proxy = f"http://127.0.0.1:{server.server_address[1]}"
+    env = dict(os.environ, http_proxy=proxy, HTTP_PROXY=proxy, no_proxy='', NO_PROXY='')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    command = [sys.executable, os.path.abspath(__file__), '--run', name, '--directory', directory,
+               '--result', result, '--seed', options.seed, '--max-pages', str(options.max_pages),
+               '--workers', str(options.workers)]
+    if not options.politeness:
+        command.append('--no-politeness')
+    if not options.pipelines:
+        command.append('--no-pipelines')
+    server.reset()
+    output = None if options.verbose else subprocess.DEVNULL
+    try:
+        subprocess.run(command, env=env, cwd=directory, stdout=output, stderr=output, check=True)
+        with open(result) as fptr:
+            stats = json.load(fptr)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    stats.update(server.stats())
+    return stats
+
+
+def report(results):
+    print(f"{'crawler':<10}{'pages':>7}{'seconds':>9}{'pages/s':>9}{'KB':>9}{'requests':>10}{'refetched':>11}"
+          f"{'dup pages':>11}{'RSS MB':>8}{'ms/page':>9}")
+    for name, stats in results.items():
+        per_page = stats['extraction_seconds'] / stats['parsed'] * 1000 if stats['parsed'] else 0
+        print(f"{name:<10}{stats['pages']:>7}{stats['seconds']:>9.1f}{stats['pages'] / stats['seconds']:>9.1f}"
+              f"{stats['bytes'] / 1024:>9.0f}{stats['requests']:>10}{stats['refetches']:>11}"
+              f"{stats['duplicate_pages']:>11}{stats['peak_rss_mb']:>8.0f}{per_page:>9.2f}")
+    for name, stats in results.items():
+        print(f"{name} statuses: {stats['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl a synthetic uic.edu-like site served locally")
+    parser.add_argument('--pages', type=int, default=300, help="pages of the site")
+    parser.add_argument('--fanout', type=int, default=8, help="links of every page to other pages")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="share of pages repeating another page")
+    parser.add_argument('--slow', type=float, default=0.1, help="share of pages on the slow host")
+    parser.add_argument('--slow-delay', type=float, default=0.5, help="seconds the slow host takes to answer")
+    parser.add_argument('--failing', type=float, default=0.05, help="share of pages on the host answering 503")
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--max-pages', type=int, default=None, help="page limit of the crawlers, all pages by default")
+    parser.add_argument('--crawlers', default=','.join(RUNNERS), help="comma separated, of " + ", ".join(RUNNERS))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="processes of the parallel crawl")
+    parser.add_argument('--no-politeness', dest='politeness', action='store_false',
+                        help="do not pace the requests to every host")
+    parser.add_argument('--no-pipelines', dest='pipelines', action='store_false',
+                        help="do not index the spider's items while it crawls")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="show the output of the crawlers")
+    # used by the crawler processes
+    parser.add_argument('--run', choices=list(RUNNERS), help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    parser.add_argument('--seed', default=f"http://{HOST}/", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.run:
+        child(options)
+        return
+    if options.max_pages is None:
+        options.max_pages = options.pages
+    site = SyntheticSite(options.pages, options.fanout, options.duplicates, options.slow, options.failing,
+                         options.random_seed)
+    server = SiteServer(site, options.slow_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{len(site.pages)} pages, {len(site.duplicate_of)} duplicates, "
+          f"{sum(1 for url in site.urls if SLOW_HOST in url)} slow, "
+          f"{sum(1 for url in site.urls if FAILING_HOST in url)} failing")
+    results = {}
+    for name in options.crawlers.split(','):
+        results[name] = benchmark(name, options, server)
+    server.shutdown()
+    report(results)
+    if options.json:
+        with open(options.json, 'w') as fptr:
+            json.dump(results, fptr, indent=4)
+
+
+if __name__ == '__main__':
+    main()
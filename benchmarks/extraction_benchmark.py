@@ -0,0 +1,149 @@
+"""
+Compares the single pass ContentExtractor with the multi pass BeautifulSoup
+extraction the crawlers used before, on the saved pages in fixtures/.
+
+    python benchmarks/extraction_benchmark.py [repeats]
+
+For the settings of crawler.py and of the Scrapy spider it checks that both
+keep the same body texts and anchor texts, then reports the time per page.
+"""
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from extraction import ContentExtractor, lxml  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def crawler_clean_text(text):
+    text = re.sub(r"[^a-zA-Z ]", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip()
+
+
+def spider_clean_text(text):
+    text = re.sub(r"[^a-zA-Z0-9 -,.&\"%$@()]", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip()
+
+
+CONFIGS = {
+    'crawler': {'filter_file': 'data_filter.txt', 'clean_text': crawler_clean_text,
+                'class_pattern': '(title|description|text|quote|course)', 'container_tags': ('div', 'section')},
+    'spider': {'filter_file': 'WebCrawl/spiders/data_filter.txt', 'clean_text': spider_clean_text,
+               'class_pattern': '(title|description|text|quote|course|intro|content)',
+               'container_tags': ('div', 'section', 'span')},
+}
+
+
+def legacy_extract(html, filter_text, clean_text, class_pattern, container_tags):
+    '''
+    The add_body / add_content loops the crawlers had before extraction.py
+    :return: (set of kept body texts, list of kept anchor texts)
+    '''
+    url_text = set()
+    soup = BeautifulSoup(html, 'html.parser')
+    regex = re.compile(class_pattern)
+    htags = ["h1", "h2", "h3"]
+    for tag in htags:
+        for heading in soup.find_all(tag, {"class": regex}):
+            heading = heading.getText()
+            heading = clean_text(heading.lower())
+            url_text.add(heading)
+    for tag in container_tags:
+        for EachPart in soup.find_all(tag, {"class": regex}):
+            for text in EachPart.find_all(["h1", "h2", "h3", 'title', 'p']):
+                text = text.getText()
+                text = clean_text(text.lower())
+                url_text.add(text)
+            text = EachPart.getText()
+            text = clean_text(text.lower())
+            url_text.add(text)
+    for text in soup.find_all(['p']):
+        text = text.getText()
+        text = clean_text(text.lower())
+        url_text.add(text)
+    page_body = set()
+    for utext in url_text:
+        addtext = True
+        for ftext in filter_text:
+            ftext = clean_text(ftext)
+            if ftext in utext or utext in ftext:
+                if len(utext.split()) < 20:
+                    addtext = False
+            if ftext == utext or re.match(r'skip\sto\s.*content', utext):
+                addtext = False
+        if addtext:
+            page_body.add(utext)
+    anchors = []
+    for link in soup.find_all('a'):
+        content = clean_text(link.getText().lower())
+        addtext = True
+        for ftext in filter_text:
+            ftext = clean_text(ftext)
+            if ftext in content or content in ftext:
+                addtext = False
+        if addtext:
+            anchors.append(content)
+    return page_body, anchors
+
+
+def extract(extractor, html):
+    page = extractor.parse(html)
+    body = extractor.body(page)
+    anchors = []
+    for link in page.links:
+        content = extractor.clean_text(link.text.lower())
+        if extractor.keep_anchor(content):
+            anchors.append(content)
+    return set(body.split(" . ")) if body else set(), anchors
+
+
+def timed(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES)):
+        if name.endswith('.html'):
+            with open(os.path.join(FIXTURES, name), encoding='utf-8') as fptr:
+                pages[name] = fptr.read()
+    parsers = ['lxml', 'html.parser'] if lxml is not None else ['html.parser']
+    for config_name, config in CONFIGS.items():
+        with open(os.path.join(ROOT, config['filter_file'])) as fptr:
+            filter_text = fptr.readlines()
+        options = {key: config[key] for key in ['class_pattern', 'container_tags']}
+        extractors = {parser: ContentExtractor(filter_text, config['clean_text'], parser=parser, **options)
+                      for parser in parsers}
+        print(f"{config_name}: median ms per page over {repeats} runs")
+        print(f"{'page':<24}{'KB':>6}{'legacy':>10}" + "".join(f"{parser:>13}" for parser in parsers) + f"{'speedup':>9}")
+        for name, html in pages.items():
+            expected = legacy_extract(html, filter_text, config['clean_text'], **options)
+            for parser, extractor in extractors.items():
+                body, anchors = extract(extractor, html)
+                if body != expected[0] or anchors != expected[1]:
+                    print(f"  {name} ({parser}): {len(body ^ expected[0])} body texts and "
+                          f"{len(set(anchors) ^ set(expected[1]))} anchor texts differ from the legacy extraction")
+            legacy = timed(lambda: legacy_extract(html, filter_text, config['clean_text'], **options), repeats)
+            times = [timed(lambda: extract(extractor, html), repeats) for extractor in extractors.values()]
+            print(f"{name:<24}{len(html) / 1024:>6.0f}{legacy * 1000:>10.1f}"
+                  + "".join(f"{t * 1000:>13.1f}" for t in times) + f"{legacy / min(times):>8.1f}x")
+        print()
+
+
+if __name__ == '__main__':
+    main()
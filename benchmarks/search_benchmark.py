@@ -0,0 +1,49 @@
+"""
+Checks that SearchEngine.search and SearchEngine.search_many return the
+same results for the same queries, then times a loop of single searches
+against one batched search. Runs on the index and embeddings in data/.
+
+    python benchmarks/search_benchmark.py [queries file] [metric]
+
+The queries file holds one query per line, a few course and people queries
+are used by default. It exits with status 1 when any result differs.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUERIES = ["Cornelia Caragea", "computer science courses", "graduate admissions", "machine learning research",
+           "library hours", "student housing", "financial aid deadlines", "engineering faculty"]
+
+
+def main():
+    os.chdir(ROOT)
+    from search_engine import SearchEngine
+
+    queries = QUERIES
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as fptr:
+            queries = [line.strip() for line in fptr if line.strip()]
+    metric = sys.argv[2] if len(sys.argv) > 2 else 'cosine'
+    engine = SearchEngine(fresh_start=False)
+    engine.invalidate_caches()
+    start = time.perf_counter()
+    single = [engine.search(query, metric) for query in queries]
+    single_time = time.perf_counter() - start
+    engine.invalidate_caches()
+    start = time.perf_counter()
+    batched = engine.search_many(queries, metric)
+    batched_time = time.perf_counter() - start
+    differing = [query for query, a, b in zip(queries, single, batched) if a != b]
+    for query in differing:
+        print(f"  {query!r}: search and search_many return different results")
+    print(f"{len(queries)} queries, {metric}: {single_time / len(queries) * 1000:.1f} ms per query searched "
+          f"one by one, {batched_time / len(queries) * 1000:.1f} ms per query in one batch")
+    sys.exit(1 if differing else 0)
+
+
+if __name__ == '__main__':
+    main()
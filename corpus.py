@@ -0,0 +1,128 @@
+import json
+import os
+import pickle
+import sys
+
+from crawl_store import CrawlStore
+
+
+def corpus_exists(path):
+    '''
+    :return: True if path is a corpus file or a crawl store holding records
+    '''
+    return os.path.isfile(path) or CrawlStore.exists(path)
+
+
+def iter_corpus(path, chunk_size=1000):
+    '''
+    Read the crawled pages in chunks of (url, {'title', 'atext', 'body'})
+    pairs. Line delimited json (.jsonl, one {"url", "title", "atext", "body"}
+    object per line) is streamed so only one chunk is in memory at a time;
+    .pickle and .json files hold a single dict and are loaded whole. A
+    directory is read as the segments of a crawl_store.CrawlStore, streamed
+    with CrawlStore.stream_documents.
+    :param path:
+    :param chunk_size:
+    :return:
+    '''
+    chunk = []
+    for url, text_dict in iter_documents(path):
+        chunk.append((url, text_dict))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_documents(path):
+    if os.path.isdir(path):
+        yield from CrawlStore.stream_documents(path)
+        return
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as fptr:
+            for line in fptr:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                url = record.pop('url')
+                record.setdefault('title', "")
+                yield url, record
+        return
+    if path.endswith('.json'):
+        with open(path, encoding='utf-8') as fptr:
+            data = json.load(fptr)
+    else:
+        with open(path, 'rb') as fptr:
+            data = pickle.load(fptr)
+    for url, text_dict in data.items():
+        text_dict.setdefault('title', "")
+        yield url, text_dict
+
+
+def write_jsonl(documents, path):
+    '''
+    :param documents: iterable of (url, text_dict) pairs
+    :param path:
+    :return:
+    '''
+    with open(path + '.tmp', 'w', encoding='utf-8') as fptr:
+        for url, text_dict in documents:
+            record = {"url": url}
+            record.update(text_dict)
+            fptr.write(json.dumps(record) + "\n")
+    os.replace(path + '.tmp', path)
+
+
+def rewrite_corpus(path, changes):
+    '''
+    Apply changes to a corpus file, keeping the order of its documents.
+    Changed documents stay in place, new ones are appended in the order of
+    changes. Changes to a crawl store are appended to it as records.
+    :param path:
+    :param changes: {url: text_dict}, None deletes the url
+    :return:
+    '''
+    def documents():
+        for url, text_dict in iter_documents(path):
+            if url not in changes:
+                yield url, text_dict
+            elif changes[url] is not None:
+                yield url, changes[url]
+            seen.add(url)
+        for url, text_dict in changes.items():
+            if url not in seen and text_dict is not None:
+                yield url, text_dict
+
+    if os.path.isdir(path):
+        store = CrawlStore(path, replay=False)
+        for url, text_dict in changes.items():
+            if text_dict is None:
+                store.delete_document(url)
+            else:
+                store.put_document(url, text_dict)
+        store.close()
+        return
+    seen = set()
+    if path.endswith('.jsonl'):
+        write_jsonl(documents(), path)
+        return
+    data = dict(documents())
+    if path.endswith('.json'):
+        with open(path + '.tmp', 'w', encoding='utf-8') as fptr:
+            json.dump(data, fptr, indent=4)
+    else:
+        with open(path + '.tmp', 'wb') as fptr:
+            pickle.dump(data, fptr)
+    os.replace(path + '.tmp', path)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: python corpus.py data/data.pickle data/data.jsonl")
+        return
+    write_jsonl(iter_documents(sys.argv[1]), sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
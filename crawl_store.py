@@ -0,0 +1,333 @@
+import json
+import os
+import re
+
+from frontier import EdgeStore
+
+
+class CrawlState:
+    """
+    Everything a crawl store holds, rebuilt by replaying its records
+    """
+
+    def __init__(self):
+        # url: {'title', 'anchors' (dict used as an ordered set), 'body'}, in the order urls were first seen
+        self.documents = {}
+        self.crawled = set()
+        self.queued = {}
+        self.edges = EdgeStore()
+        # parent: children, to follow the links of a page again without parsing it
+        self.links = {}
+        # near duplicate fingerprints of the crawled pages
+        self.fingerprints = {}
+        # url: {'etag', 'last_modified', 'hash'} sent back by refresh crawls
+        self.validators = {}
+
+    def document(self, url):
+        if url not in self.documents:
+            self.documents[url] = {'title': None, 'anchors': {}, 'body': ""}
+        return self.documents[url]
+
+    def apply(self, record):
+        kind = record['type']
+        if kind == 'page':
+            document = self.document(record['url'])
+            document['title'] = record['title']
+            document['body'] = record['body']
+            self.crawled.add(record['url'])
+            if record.get('fingerprint') is not None:
+                self.fingerprints[record['url']] = record['fingerprint']
+        elif kind == 'anchor':
+            self.document(record['url'])['anchors'][record['text']] = None
+        elif kind == 'title':
+            self.document(record['url'])['title'] = record['title']
+        elif kind == 'edge':
+            if self.edges.add((record['parent'], record['child'])):
+                self.links.setdefault(record['parent'], []).append(record['child'])
+        elif kind == 'crawled':
+            self.crawled.add(record['url'])
+        elif kind == 'queued':
+            self.queued[record['url']] = None
+        elif kind == 'validators':
+            self.validators[record['url']] = {key: record[key] for key in ['etag', 'last_modified', 'hash']}
+        elif kind == 'document':
+            self.documents[record['url']] = {'title': record['title'],
+                                             'anchors': dict.fromkeys(record['anchors']),
+                                             'body': record['body']}
+            if record.get('crawled'):
+                self.crawled.add(record['url'])
+            if record.get('fingerprint') is not None:
+                self.fingerprints[record['url']] = record['fingerprint']
+        elif kind == 'delete':
+            self.documents.pop(record['url'], None)
+            self.fingerprints.pop(record['url'], None)
+            self.validators.pop(record['url'], None)
+
+    def seen(self, url):
+        return url in self.queued or url in self.crawled
+
+    def frontier(self):
+        '''
+        :return: urls queued but not crawled, in the order they were queued
+        '''
+        return [url for url in self.queued if url not in self.crawled]
+
+
+class CrawlStore:
+    """
+    Append-only storage of a crawl in a directory of JSON lines segments.
+
+    Every page, anchor text, title, link and queued url, and the ETag,
+    Last-Modified and content hash a refresh crawl sends back, is appended
+    to the current segment as one record, so saving costs the size of what
+    is new.
+    A new segment is started every segment_size records. Once there are more
+    than max_segments, compaction writes the replayed state as a snapshot
+    and removes the segments and snapshot it replaces. Opening a store
+    replays the latest snapshot and the segments after it, which is how an
+    interrupted crawl gets back its pages, frontier and seen set. A
+    truncated last record, from a crawl that was killed mid-write, is
+    ignored. stream_documents reads the documents of a store without
+    replaying it into memory, and a store opened with replay=False only
+    appends document and delete records to it.
+    """
+    segment_pattern = re.compile(r'(segment|snapshot)-(\d+)\.jsonl$')
+
+    def __init__(self, directory, segment_size=100000, max_segments=8, replay=True):
+        '''
+        :param directory:
+        :param segment_size:
+        :param max_segments:
+        :param replay: load the stored crawl. A store opened without it knows
+        nothing of what is stored, so it never compacts, and is only meant for
+        put_document and delete_document
+        '''
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.replay = replay
+        os.makedirs(directory, exist_ok=True)
+        self.state = CrawlState()
+        self.segment_number = 0
+        self.num_records = 0
+        self.fptr = None
+        if replay:
+            self.load()
+        else:
+            self.segment_number = max([number for number, _, _ in self.files()], default=0)
+
+    def files(self):
+        '''
+        :return: [(number, kind, path)] of the segments and snapshots, oldest first
+        '''
+        return self.list_files(self.directory)
+
+    @classmethod
+    def list_files(cls, directory):
+        files = []
+        for name in os.listdir(directory):
+            match = cls.segment_pattern.match(name)
+            if match:
+                files.append((int(match.group(2)), match.group(1), os.path.join(directory, name)))
+        return sorted(files)
+
+    @classmethod
+    def replayed_files(cls, directory):
+        '''
+        :return: [(number, path)] of the latest snapshot and the segments after it, the files load replays
+        '''
+        files = cls.list_files(directory)
+        snapshots = [number for number, kind, _ in files if kind == 'snapshot']
+        start = max(snapshots) if snapshots else 0
+        return [(number, path) for number, kind, path in files
+                if number > start or (number == start and kind == 'snapshot')]
+
+    def load(self):
+        for number, path in self.replayed_files(self.directory):
+            for record in self.read(path):
+                self.state.apply(record)
+            self.segment_number = max(self.segment_number, number)
+        return self.state
+
+    @staticmethod
+    def read(path):
+        with open(path, encoding='utf-8') as fptr:
+            for line in fptr:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+
+    @staticmethod
+    def read_offsets(path):
+        '''
+        :return: (byte offset, record) of the records of a segment or snapshot
+        '''
+        offset = 0
+        with open(path, 'rb') as fptr:
+            for line in fptr:
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    return
+                offset += len(line)
+
+    def append(self, record):
+        self.state.apply(record)
+        if self.fptr is None:
+            self.segment_number += 1
+            path = os.path.join(self.directory, f"segment-{self.segment_number:06d}.jsonl")
+            self.fptr = open(path, 'a', encoding='utf-8')
+            self.num_records = 0
+        self.fptr.write(json.dumps(record) + "\n")
+        self.num_records += 1
+        if self.num_records >= self.segment_size:
+            self.roll()
+
+    def roll(self):
+        self.fptr.close()
+        self.fptr = None
+        if self.replay and sum(kind == 'segment' for _, kind, _ in self.files()) > self.max_segments:
+            self.compact()
+
+    def add_page(self, url, title, body, fingerprint=None):
+        self.append({'type': 'page', 'url': url, 'title': title, 'body': body, 'fingerprint': fingerprint})
+
+    def add_crawled(self, url):
+        '''
+        Mark a url fetched without keeping a page for it
+        '''
+        if url not in self.state.crawled:
+            self.append({'type': 'crawled', 'url': url})
+
+    def add_anchor(self, url, text):
+        if text not in self.state.document(url)['anchors']:
+            self.append({'type': 'anchor', 'url': url, 'text': text})
+
+    def add_title(self, url, title):
+        self.append({'type': 'title', 'url': url, 'title': title})
+
+    def add_edge(self, parent, child):
+        if (parent, child) not in self.state.edges:
+            self.append({'type': 'edge', 'parent': parent, 'child': child})
+
+    def add_validators(self, url, validators):
+        '''
+        :param validators: {'etag', 'last_modified', 'hash'}, see refresh.response_validators
+        '''
+        if self.state.validators.get(url) != validators:
+            self.append(dict(validators, type='validators', url=url))
+
+    def add_queued(self, url):
+        if url not in self.state.queued:
+            self.append({'type': 'queued', 'url': url})
+
+    def put_document(self, url, text_dict):
+        '''
+        Replace a document with {'title', 'atext', 'body'}
+        '''
+        self.append({'type': 'document', 'url': url, 'title': text_dict.get('title', ""),
+                     'anchors': [text_dict['atext']] if text_dict.get('atext') else [], 'body': text_dict['body'],
+                     'crawled': url in self.state.crawled})
+
+    def delete_document(self, url):
+        self.append({'type': 'delete', 'url': url})
+
+    def flush(self):
+        if self.fptr is not None:
+            self.fptr.flush()
+
+    def close(self):
+        if self.fptr is not None:
+            self.fptr.close()
+            self.fptr = None
+
+    def compact(self):
+        '''
+        Replace every segment and snapshot by one snapshot of the current state
+        '''
+        self.close()
+        number = self.segment_number
+        path = os.path.join(self.directory, f"snapshot-{number:06d}.jsonl")
+        with open(path + '.tmp', 'w', encoding='utf-8') as fptr:
+            for url, document in self.state.documents.items():
+                fptr.write(json.dumps({'type': 'document', 'url': url, 'title': document['title'],
+                                       'anchors': list(document['anchors']), 'body': document['body'],
+                                       'crawled': url in self.state.crawled,
+                                       'fingerprint': self.state.fingerprints.get(url)}) + "\n")
+            for url in self.state.crawled:
+                if url not in self.state.documents:
+                    fptr.write(json.dumps({'type': 'crawled', 'url': url}) + "\n")
+            for url in self.state.queued:
+                fptr.write(json.dumps({'type': 'queued', 'url': url}) + "\n")
+            for parent, child in self.state.edges:
+                fptr.write(json.dumps({'type': 'edge', 'parent': parent, 'child': child}) + "\n")
+            for url, validators in self.state.validators.items():
+                fptr.write(json.dumps(dict(validators, type='validators', url=url)) + "\n")
+        os.replace(path + '.tmp', path)
+        for old_number, kind, old_path in self.files():
+            if old_number < number or (old_number == number and kind == 'segment'):
+                os.remove(old_path)
+
+    def documents(self):
+        '''
+        :return: (url, {'title', 'atext', 'body'}) of every document, as corpus.iter_documents
+        '''
+        for url, document in self.state.documents.items():
+            yield url, {'title': document['title'] or "",
+                        'atext': " . ".join(document['anchors']),
+                        'body': document['body']}
+
+    @classmethod
+    def stream_documents(cls, directory):
+        '''
+        Documents of the store in a directory, as documents() of the opened
+        store, without holding their text in memory: a first pass over the
+        replayed files keeps, for every url, its title and the offsets of
+        the records holding its body and anchor texts, a second pass reads
+        them back one document at a time.
+        :return: (url, {'title', 'atext', 'body'}) of every document
+        '''
+        paths = [path for _, path in cls.replayed_files(directory)]
+        # url: [title, (file, offset) of the record of its body, of its document record,
+        # [(file, offset) of its anchor records after it]]
+        entries = {}
+        for file, path in enumerate(paths):
+            for offset, record in cls.read_offsets(path):
+                kind = record['type']
+                if kind == 'delete':
+                    entries.pop(record['url'], None)
+                    continue
+                if kind not in ('page', 'anchor', 'title', 'document'):
+                    continue
+                entry = entries.setdefault(record['url'], [None, None, None, []])
+                if kind == 'anchor':
+                    entry[3].append((file, offset))
+                    continue
+                entry[0] = record['title']
+                if kind == 'page':
+                    entry[1] = (file, offset)
+                elif kind == 'document':
+                    entry[1] = entry[2] = (file, offset)
+                    entry[3] = []
+        fptrs = [open(path, 'rb') for path in paths]
+
+        def read_at(file, offset):
+            fptrs[file].seek(offset)
+            return json.loads(fptrs[file].readline())
+
+        try:
+            for url, (title, body_ref, document_ref, anchor_refs) in entries.items():
+                body = read_at(*body_ref)['body'] if body_ref is not None else ""
+                anchors = dict.fromkeys(read_at(*document_ref)['anchors']) if document_ref is not None else {}
+                for ref in anchor_refs:
+                    anchors[read_at(*ref)['text']] = None
+                yield url, {'title': title or "", 'atext': " . ".join(anchors), 'body': body}
+        finally:
+            for fptr in fptrs:
+                fptr.close()
+
+    @staticmethod
+    def exists(directory):
+        return os.path.isdir(directory) and any(CrawlStore.segment_pattern.match(name)
+                                                for name in os.listdir(directory))
@@ -2,14 +2,22 @@ import json
 import logging
 import pickle
 import re
+import sys
+import time
 from urllib.parse import urljoin, urlparse
 
 MAX_FILE_SIZE = 1024 * 1024
 import hashlib
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 import requests
-from bs4 import BeautifulSoup
+
+from extraction import ContentExtractor
+from frontier import Frontier
+from near_duplicates import SimHashIndex
+from politeness import PolitenessScheduler
+from refresh import GONE_STATUSES, Manifest, conditional_headers, content_hash, response_validators
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s:%(message)s',
@@ -38,37 +46,145 @@ class Crawler:
     url_to_content = {}
     url_to_body = {}
     filter_text = open('data_filter.txt', 'r').readlines()
-    all_md5 = []
+    allowed_domain = "uic.edu"
+    data_file = "data/data.json"
+    refresh_file = "data/refresh.json"
+    manifest_file = "data/manifest.json"
+    stats_file = "data/politeness_stats.json"
 
-    def __init__(self, urls=[], max_pages=5000):
+    def __init__(self, urls=[], max_pages=5000, max_distance=3, strategy=None, refresh=False, politeness=None):
+        '''
+        :param urls: seed urls
+        :param max_pages:
+        :param max_distance: pages whose SimHash fingerprints differ in at most this many bits are duplicates
+        :param strategy: crawl order, see frontier.Frontier. Breadth first by default
+        :param refresh: refresh the previous crawl: pages are requested only if they changed since it,
+        unchanged ones are not parsed and the changed, added and removed pages are saved to manifest_file.
+        The body of the changed and added pages is kept in data_file, for
+        SearchEngine.apply_manifest(source=Crawler.data_file)
+        :param politeness: PolitenessScheduler pacing the requests to every host, a default one if None
+        '''
         self.all_urls = urls.copy()
         self.max_pages = max_pages
-        self.urls_to_visit = urls
+        self.seeds = list(urls)
+        self.frontier = Frontier(strategy)
+        for url in urls:
+            self.frontier.add(url)
+        self.duplicates = SimHashIndex(max_distance)
+        self.extractor = ContentExtractor(self.filter_text, self.clean_text)
+        self.link_graph = []
+        self.visited_urls = set()
+        self.url_to_content = {}
+        self.url_to_body = {}
+        # url: ETag, Last-Modified, content hash, links and fingerprint, saved to refresh_file
+        self.pages = {}
+        self.fingerprints = {}
+        self.previous = {}
+        self.manifest = None
+        self.complete = False
+        self.politeness = politeness or PolitenessScheduler()
+        if refresh:
+            with open(self.refresh_file) as fptr:
+                self.previous = json.load(fptr)
+            self.manifest = Manifest(url for url, stored in self.previous.items() if 'links' in stored)
+
+    def fetch_robots(self, url):
+        '''
+        Read the crawl-delay of the url's host the first time the host is requested
+        '''
+        robots_url = self.politeness.needs_robots(url)
+        if robots_url is None:
+            return
+        try:
+            response = requests.get(robots_url, timeout=10)
+            text = response.text if response.status_code == 200 else ""
+        except requests.RequestException:
+            text = ""
+        self.politeness.set_robots(url, text)
+
+    def download(self, url):
+        self.fetch_robots(url)
+        self.politeness.wait(url)
+        start = time.monotonic()
+        try:
+            response = requests.get(url, headers=conditional_headers(self.previous.get(url)))
+        except requests.RequestException:
+            self.politeness.release(url, time.monotonic() - start, None)
+            raise
+        self.politeness.release(url, time.monotonic() - start, response.status_code, len(response.content))
+        return response
+
+    def unchanged(self, url, status, content):
+        '''
+        :param url:
+        :param status: status of the response
+        :param content: body of the response, in bytes
+        :return: what the refreshed crawl kept of url if the response shows that the page did not change, else None
+        '''
+        stored = self.previous.get(url)
+        if stored is None or 'links' not in stored:
+            return None
+        if status == 304 or content_hash(content) == stored['hash']:
+            return stored
+        return None
 
-    def download_url(self, url):
-        return requests.get(url).text
+    def record_page(self, url, headers, content, links, page):
+        '''
+        :param page: the page parsed by the extractor
+        '''
+        self.pages[url] = dict(response_validators(headers, content), links=links)
+        if self.manifest is not None:
+            self.manifest.updated(url)
+            # apply_manifest reindexes the changed and added pages from data_file
+            self.url_to_body[url] = self.extractor.body(page)
 
-    def get_linked_urls(self, url, html):
-        soup = BeautifulSoup(html, 'html.parser')
-        for link in soup.find_all('a'):
-            path = link.get('href')
+    def linked_urls(self, url, page):
+        '''
+        :param url: url of the page
+        :param page: page parsed by the extractor
+        :return: (url, anchor strings) of every link of the page, relative links made absolute
+        '''
+        for link in page.links:
+            path = link.href
             if path and path.startswith('/'):
                 path = urljoin(url, path)
-            domain = urlparse(path).netloc
-            if not self.is_unique(path) or self.a_file(path) or "uic.edu" not in domain \
-                    or path in self.visited_urls \
-                    or path in self.urls_to_visit:
-                self.visited_urls.add(path)
+            yield path, link.strings
+
+    def get_linked_urls(self, url, links):
+        '''
+        :param url: url of the page
+        :param links: (url, anchor strings) of the links of the page
+        :return:
+        '''
+        for path, contents in links:
+            if not path or self.a_file(path) or self.allowed_domain not in urlparse(path).netloc:
+                continue
+            if path not in self.frontier and not self.is_unique(path):
+                self.frontier.mark_seen(path)
                 continue
-            self.add_content(path, url, link.contents)
-            self.urls_to_visit.append(path)
-            self.add_link(url, path)
+            if self.frontier.add(path, parent=url):
+                self.add_content(path, url, contents)
+                self.add_link(url, path)
 
     def crawl(self, url):
-        html = self.download_url(url)
+        response = self.download(url)
         self.visited_urls.add(url)
+        if self.manifest is not None and response.status_code in GONE_STATUSES:
+            self.manifest.gone(url)
+            return
+        stored = self.unchanged(url, response.status_code, response.content)
+        if stored is not None:
+            # the links of an unchanged page are followed without parsing it again
+            self.pages[url] = stored
+            self.manifest.unchanged(url)
+            self.get_linked_urls(url, stored['links'])
+            return
+        html = response.text
         # self.add_body(url, html)
-        self.get_linked_urls(url, html)
+        page = self.extractor.parse(html)
+        links = list(self.linked_urls(url, page))
+        self.record_page(url, response.headers, response.content, links, page)
+        self.get_linked_urls(url, links)
 
     def add_content(self, url, parent, content):
         for c in content:
@@ -79,25 +195,56 @@ class Crawler:
                         self.url_to_content[url] = {}
                     if parent not in self.url_to_content[url]:
                         self.url_to_content[url][parent] = set()
-                    for ftext in self.filter_text:
-                        ftext = self.clean_text(ftext)
-                        if ftext not in c:
-                            self.url_to_content[url][parent].add(c)
+                    if self.extractor.keep_anchor(c):
+                        self.url_to_content[url][parent].add(c)
 
     def txt_md5(self, txt):
         txt = txt.encode('utf-8')
         return hashlib.md5(txt).hexdigest()
 
-    def is_unique(self, url):
+    def page_fingerprint(self, page):
+        '''
+        :param page: page parsed by the extractor
+        :return: SimHash of the kept body, of the head and body text if it has none,
+        raises if the page has no head or body
+        '''
+        if page.head_text is None or page.body_text is None:
+            raise ValueError("page without head or body")
+        return self.duplicates.fingerprint(
+            self.extractor.fingerprint_text(page, text=page.head_text + " " + page.body_text))
+
+    def fetch_fingerprint(self, url):
+        '''
+        :return: fingerprint of the page, the one of the refreshed crawl if the page did not change
+        '''
+        stored = self.previous.get(url, {})
+        self.fetch_robots(url)
+        self.politeness.wait(url)
+        start = time.monotonic()
+        status, r = None, b""
         try:
-            c = urlopen(url)
+            c = urlopen(Request(url, headers=conditional_headers(stored)))
+            status = c.status
             r = c.read(MAX_FILE_SIZE)
-            soup = BeautifulSoup(r, features="lxml")
-            header = soup.find('head').text
-            body = soup.find('body').text
-            md5 = [self.txt_md5(h) for h in [header, body]]
-            if md5 not in self.all_md5:
-                self.all_md5.append(md5)
+        except HTTPError as error:
+            status = error.code
+            if self.manifest is not None and error.code in GONE_STATUSES:
+                self.manifest.gone(url)
+            if error.code == 304 and stored.get('fingerprint') is not None:
+                return stored['fingerprint']
+            raise
+        finally:
+            self.politeness.release(url, time.monotonic() - start, status, len(r))
+        if stored.get('fingerprint') is not None and content_hash(r) == stored.get('hash'):
+            return stored['fingerprint']
+        return self.page_fingerprint(self.extractor.parse(r))
+
+    def is_unique(self, url):
+        try:
+            fingerprint = self.fetch_fingerprint(url)
+            self.fingerprints[url] = fingerprint
+            if self.duplicates.find(fingerprint) is None:
+                self.duplicates.add(url, fingerprint)
                 self.all_urls.append(url)
                 return True
             else:
@@ -112,42 +259,7 @@ class Crawler:
         return text.strip()
 
     def add_body(self, url, html):
-        url_text = set()
-        soup = BeautifulSoup(html, 'html.parser')
-        regex = re.compile('(title|description|text|quote|course)')
-        htags = ["h1", "h2", "h3"]
-        for tag in htags:
-            for heading in soup.find_all(tag, {"class": regex}):
-                heading = heading.getText()
-                heading = self.clean_text(heading.lower())
-                url_text.add(heading)
-        for tag in ['div', 'section']:
-            for EachPart in soup.find_all(tag, {"class": regex}):
-                for text in EachPart.find_all(["h1", "h2", "h3", 'title', 'p']):
-                    text = text.getText()
-                    text = self.clean_text(text.lower())
-                    url_text.add(text)
-                text = EachPart.getText()
-                text = self.clean_text(text.lower())
-                url_text.add(text)
-
-        for text in soup.find_all(['p']):
-            text = text.getText()
-            text = self.clean_text(text.lower())
-            url_text.add(text)
-        page_body = []
-        for utext in url_text:
-            addtext = True
-            for ftext in self.filter_text:
-                ftext = self.clean_text(ftext)
-                if ftext in utext or utext in ftext:
-                    if len(utext.split()) < 20:
-                        addtext = False
-                if ftext == utext or re.match(r'skip\sto\s.*content', utext):
-                    addtext = False
-            if addtext:
-                page_body += [utext]
-        self.url_to_body[url] = " . ".join(page_body)
+        self.url_to_body[url] = self.extractor.body(self.extractor.parse(html))
 
     def get_data(self):
         data = {}
@@ -180,16 +292,20 @@ class Crawler:
     def run(self):
         urlnum = 0
         while urlnum < self.max_pages:
-            if not self.urls_to_visit:
+            if not self.frontier:
                 break
-            url = self.urls_to_visit.pop(0)
+            url = self.frontier.pop()
             logging.info(f'{urlnum}) Crawling: {url}')
             try:
                 self.crawl(url)
                 urlnum += 1
             except Exception:
                 logging.exception(f'Failed to crawl: {url}')
-        with open("data/data.json", "w") as outfile:
+        self.complete = not self.frontier
+        self.save()
+
+    def save(self):
+        with open(self.data_file, "w") as outfile:
             json.dump(self.get_data(), outfile, indent=4)
             outfile.close()
         with open("data/link_graph2.pickle", "wb") as gfile:
@@ -198,11 +314,28 @@ class Crawler:
         with open("all_links.pickle", "wb") as linkfile:
             pickle.dump(self.all_urls, linkfile)
             linkfile.close()
+        with open(self.refresh_file, "w") as rfile:
+            json.dump(self.refresh_state(), rfile)
+        self.politeness.save_stats(self.stats_file)
+        if self.manifest is not None:
+            self.manifest.finish(self.complete)
+            self.manifest.save(self.manifest_file)
+
+    def refresh_state(self):
+        '''
+        :return: {url: {'etag', 'last_modified', 'hash', 'links', 'fingerprint'}} for the next refresh,
+        a page only fingerprinted keeps the validators and links of the last crawl of it
+        '''
+        state = {}
+        for url in list(self.pages) + list(self.fingerprints):
+            stored = state[url] = dict(self.previous.get(url, {}))
+            stored.update(self.pages.get(url, {}))
+            if url in self.fingerprints:
+                stored['fingerprint'] = self.fingerprints[url]
+        return state
 
     def add_link(self, parent, child):
-        parent_key = self.all_urls.index(parent)
-        child_key = self.all_urls.index(child)
-        if (parent_key, child_key) not in self.link_graph:
+        if self.frontier.add_edge(parent, child):
             self.link_graph.append((parent, child))
 
     def a_file(self, url):
@@ -210,7 +343,9 @@ class Crawler:
 
 
 def main():
-    Crawler(urls=['https://cs.uic.edu/'], max_pages=100).run()
+    # python crawler.py --refresh only reparses the pages changed since the last crawl,
+    # SearchEngine().apply_manifest(source=Crawler.data_file) then reindexes them
+    Crawler(urls=['https://cs.uic.edu/'], max_pages=100, refresh='--refresh' in sys.argv[1:]).run()
 
 
 if __name__ == '__main__':
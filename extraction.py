@@ -0,0 +1,215 @@
+import re
+from collections import namedtuple
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+Link = namedtuple('Link', ['href', 'strings', 'text'])
+
+HEADING_TAGS = {'h1', 'h2', 'h3'}
+INNER_TAGS = ['h1', 'h2', 'h3', 'title', 'p']
+
+
+class PhraseMatcher:
+    """
+    Finds whether any of a set of phrases occurs in a text in one scan,
+    with an Aho-Corasick automaton when pyahocorasick is installed and a
+    compiled regular expression alternation otherwise.
+    """
+
+    def __init__(self, phrases):
+        self.phrases = [phrase for phrase in dict.fromkeys(phrases) if phrase]
+        # every substring of a phrase, to tell whether a text occurs in a phrase
+        self.substrings = {phrase[i:j] for phrase in self.phrases
+                           for i in range(len(phrase)) for j in range(i, len(phrase) + 1)}
+        self.substrings.add("")
+        self.automaton = None
+        self.pattern = None
+        if ahocorasick is not None and self.phrases:
+            self.automaton = ahocorasick.Automaton()
+            for phrase in self.phrases:
+                self.automaton.add_word(phrase, phrase)
+            self.automaton.make_automaton()
+        elif self.phrases:
+            self.pattern = re.compile("|".join(re.escape(phrase) for phrase in self.phrases))
+
+    def search(self, text):
+        '''
+        :return: True if a phrase occurs in text
+        '''
+        if self.automaton is not None:
+            for _ in self.automaton.iter(text):
+                return True
+            return False
+        return self.pattern is not None and self.pattern.search(text) is not None
+
+    def within(self, text):
+        '''
+        :return: True if text occurs in a phrase
+        '''
+        return text in self.substrings
+
+
+class Page:
+    """
+    What the crawlers keep of a parsed page
+    """
+
+    def __init__(self):
+        self.title = None
+        self.head_text = None
+        self.body_text = None
+        self.text = ""
+        self.links = []
+        # candidate body texts in document order, without repeats
+        self.fragments = {}
+
+
+class ContentExtractor:
+    """
+    Extracts the title, links and body text of a page in a single parse and
+    a single walk over its elements, with lxml when it is installed and
+    html.parser otherwise.
+
+    The body is made of the text of h1-h3 headings whose class matches
+    class_pattern, of the container_tags whose class matches and of their
+    h1-h3, title and p descendants, and of every p, as the crawlers'
+    add_body did. The filter phrases are cleaned once and matched together
+    by a PhraseMatcher.
+    """
+
+    def __init__(self, filter_text, clean_text, class_pattern='(title|description|text|quote|course)',
+                 container_tags=('div', 'section'), parser=None):
+        '''
+        :param filter_text: lines of data_filter.txt
+        :param clean_text: the crawler's text normalisation, applied to the filter phrases and the extracted texts
+        :param class_pattern:
+        :param container_tags:
+        :param parser: 'lxml' or 'html.parser', lxml if installed by default
+        '''
+        self.clean_text = clean_text
+        phrases = [clean_text(ftext) for ftext in filter_text]
+        self.phrases = set(phrases)
+        self.matcher = PhraseMatcher(phrases)
+        self.class_pattern = re.compile(class_pattern)
+        self.container_tags = set(container_tags)
+        self.skip_pattern = re.compile(r'skip\sto\s.*content')
+        self.parser = parser or ('lxml' if lxml is not None else 'html.parser')
+        if self.parser == 'lxml':
+            self.html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+    def parse(self, html):
+        '''
+        :param html: str or bytes
+        :return: Page
+        '''
+        if self.parser == 'lxml':
+            return self.parse_lxml(html)
+        return self.parse_soup(html)
+
+    def parse_lxml(self, html):
+        page = Page()
+        if isinstance(html, str):
+            html = html.encode('utf-8')
+        try:
+            root = lxml.html.document_fromstring(html, parser=self.html_parser)
+        except (lxml.etree.ParserError, ValueError):
+            return page
+        page.text = root.text_content()
+        for element in root.iter():
+            tag = element.tag
+            if not isinstance(tag, str):
+                continue
+            if tag == 'a':
+                strings = [element.text or ""] + [child.tail or "" for child in element]
+                page.links.append(Link(element.get('href'), [s for s in strings if s], element.text_content()))
+            elif tag == 'p':
+                page.fragments[element.text_content()] = None
+            elif tag == 'title':
+                if page.title is None:
+                    page.title = element.text_content()
+            elif tag == 'head':
+                page.head_text = element.text_content()
+            elif tag == 'body':
+                page.body_text = element.text_content()
+            if tag in HEADING_TAGS or tag in self.container_tags:
+                self.add_classed(page, tag, element.get('class'), element.text_content,
+                                 lambda: (inner.text_content() for inner in element.iterdescendants(*INNER_TAGS)))
+        return page
+
+    def parse_soup(self, html):
+        page = Page()
+        soup = BeautifulSoup(html, self.parser)
+        page.text = soup.get_text(" ")
+        for element in soup.find_all(True):
+            tag = element.name
+            if tag == 'a':
+                page.links.append(Link(element.get('href'), [c for c in element.contents if isinstance(c, str)],
+                                       element.getText()))
+            elif tag == 'p':
+                page.fragments[element.getText()] = None
+            elif tag == 'title':
+                if page.title is None:
+                    page.title = element.getText()
+            elif tag == 'head':
+                page.head_text = element.getText()
+            elif tag == 'body':
+                page.body_text = element.getText()
+            if tag in HEADING_TAGS or tag in self.container_tags:
+                classes = element.get('class')
+                self.add_classed(page, tag, " ".join(classes) if classes else None, element.getText,
+                                 lambda: (inner.getText() for inner in element.find_all(INNER_TAGS)))
+        return page
+
+    def add_classed(self, page, tag, classes, text, inner_texts):
+        if not classes or not self.class_pattern.search(classes):
+            return
+        if tag in self.container_tags:
+            for inner in inner_texts():
+                page.fragments[inner] = None
+        page.fragments[text()] = None
+
+    def keep_fragment(self, text):
+        '''
+        add_body's filter: short texts that contain a filter phrase or occur
+        in one are dropped, as are the filter phrases themselves and skip to
+        content links
+        '''
+        if len(text.split()) < 20 and (self.matcher.search(text) or self.matcher.within(text)):
+            return False
+        return text not in self.phrases and not self.skip_pattern.match(text)
+
+    def keep_anchor(self, text):
+        return not (self.matcher.search(text) or self.matcher.within(text))
+
+    def body(self, page):
+        '''
+        :param page:
+        :return: the kept body texts of the page, cleaned and joined with " . "
+        '''
+        texts = dict.fromkeys(self.clean_text(text.lower()) for text in page.fragments)
+        return " . ".join(text for text in texts if self.keep_fragment(text))
+
+    def fingerprint_text(self, page, body=None, text=None):
+        '''
+        Near duplicates are found on the kept body, as the navigation and
+        footer every page of a templated site shares would make different
+        pages look alike
+        :param page:
+        :param body: self.body(page), if already extracted
+        :param text: text of a page that keeps no body, page.text by default
+        :return: the text to fingerprint
+        '''
+        if body is None:
+            body = self.body(page)
+        return body or (page.text if text is None else text)
@@ -0,0 +1,216 @@
+import heapq
+from collections import deque
+
+
+class UrlTable:
+    """
+    Interns urls as consecutive integer ids
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.urls = []
+
+    def intern(self, url):
+        node = self.ids.get(url)
+        if node is None:
+            node = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+        return node
+
+    def get(self, url):
+        return self.ids.get(url)
+
+    def __getitem__(self, node):
+        return self.urls[node]
+
+    def __len__(self):
+        return len(self.urls)
+
+
+class EdgeStore:
+    """
+    Links kept once each, in the order they were first added
+    """
+
+    def __init__(self):
+        self.edges = set()
+        self.order = []
+
+    def add(self, edge):
+        '''
+        :param edge: (parent, child)
+        :return: True if the edge is new
+        '''
+        if edge in self.edges:
+            return False
+        self.edges.add(edge)
+        self.order.append(edge)
+        return True
+
+    def __contains__(self, edge):
+        return edge in self.edges
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class BreadthFirst:
+    """
+    Pages are crawled in the order they were discovered
+    """
+
+    def __init__(self):
+        self.queue = deque()
+
+    def push(self, node, depth):
+        self.queue.append(node)
+        return True
+
+    def link(self, parent, child):
+        pass
+
+    def pop(self):
+        return self.queue.popleft()
+
+    def __len__(self):
+        return len(self.queue)
+
+
+class DepthCapped(BreadthFirst):
+    """
+    Breadth first, pages more than max_depth links away from a seed are not queued
+    """
+
+    def __init__(self, max_depth=3):
+        super().__init__()
+        self.max_depth = max_depth
+
+    def push(self, node, depth):
+        if depth > self.max_depth:
+            return False
+        return super().push(node, depth)
+
+
+class PageRankFirst:
+    """
+    Online PageRank estimate (OPIC): seeds start with one unit of cash, a
+    crawled page splits its cash between its links and the queued page
+    holding the most cash is crawled first. The links of a page are
+    distributed when the next page is popped, so a page's cash is only
+    spread once all its links are known.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.cash = {}
+        self.queued = set()
+        self.links = {}
+        self.counter = 0
+
+    def push(self, node, depth):
+        if depth == 0:
+            self.cash[node] = self.cash.get(node, 0) + 1
+        self.queued.add(node)
+        self.schedule(node)
+        return True
+
+    def schedule(self, node):
+        # ties are popped in the order they were scheduled
+        heapq.heappush(self.heap, (-self.cash.get(node, 0), self.counter, node))
+        self.counter += 1
+
+    def link(self, parent, child):
+        self.links.setdefault(parent, []).append(child)
+
+    def distribute(self):
+        for parent, children in self.links.items():
+            share = self.cash.pop(parent, 0) / len(children)
+            for child in children:
+                self.cash[child] = self.cash.get(child, 0) + share
+                if child in self.queued:
+                    self.schedule(child)
+        self.links = {}
+
+    def pop(self):
+        self.distribute()
+        while True:
+            cash, _, node = heapq.heappop(self.heap)
+            # skip entries superseded by a later schedule
+            if node in self.queued and -cash == self.cash.get(node, 0):
+                self.queued.remove(node)
+                return node
+
+    def __len__(self):
+        return len(self.queued)
+
+
+STRATEGIES = {'bfs': BreadthFirst, 'depth': DepthCapped, 'pagerank': PageRankFirst}
+
+
+class Frontier:
+    """
+    Crawl frontier: the queue of pages to crawl, ordered by a pluggable
+    strategy, with the set of urls already seen, the url to id table and
+    the link graph. Every operation is constant time on average.
+    """
+
+    def __init__(self, strategy=None):
+        '''
+        :param strategy: BreadthFirst (default), DepthCapped, PageRankFirst or
+        one of the STRATEGIES names
+        '''
+        if strategy is None or isinstance(strategy, str):
+            strategy = STRATEGIES[strategy or 'bfs']()
+        self.strategy = strategy
+        self.urls = UrlTable()
+        self.edges = EdgeStore()
+        self.seen = set()
+        self.depths = {}
+
+    def add(self, url, parent=None):
+        '''
+        Queue url unless it was seen before
+        :param url:
+        :param parent: page the url was found on, None for seeds
+        :return: True if url was queued
+        '''
+        node = self.urls.intern(url)
+        depth = 0
+        if parent is not None:
+            parent_node = self.urls.intern(parent)
+            self.strategy.link(parent_node, node)
+            depth = self.depths.get(parent_node, 0) + 1
+        if node in self.seen:
+            return False
+        self.seen.add(node)
+        self.depths[node] = depth
+        return self.strategy.push(node, depth)
+
+    def mark_seen(self, url):
+        '''
+        Never queue url
+        '''
+        self.seen.add(self.urls.intern(url))
+
+    def pop(self):
+        return self.urls[self.strategy.pop()]
+
+    def add_edge(self, parent, child):
+        '''
+        :return: True if the link is new
+        '''
+        return self.edges.add((self.urls.intern(parent), self.urls.intern(child)))
+
+    def edge_urls(self):
+        return [(self.urls[parent], self.urls[child]) for parent, child in self.edges]
+
+    def __contains__(self, url):
+        node = self.urls.get(url)
+        return node is not None and node in self.seen
+
+    def __len__(self):
+        return len(self.strategy)
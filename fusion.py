@@ -0,0 +1,84 @@
+import numpy as np
+
+
+def scores_array(size, doc_ids, scores):
+    '''
+    :param size: number of documents
+    :param doc_ids:
+    :param scores:
+    :return: array of length size with the scores at doc_ids and NaN elsewhere
+    '''
+    array = np.full(size, np.nan)
+    array[np.asarray(doc_ids, dtype=np.int64)] = scores
+    return array
+
+
+def reciprocal_ranks(scores, rrf_k=60):
+    '''
+    1 / (rrf_k + rank) of every scored document, rank 1 being the highest
+    score, 0 for documents without a score
+    '''
+    valid = np.flatnonzero(~np.isnan(scores))
+    order = valid[np.argsort(-scores[valid], kind='stable')]
+    ranks = np.zeros(len(scores))
+    ranks[order] = 1 / (rrf_k + np.arange(1, len(order) + 1))
+    return ranks
+
+
+def min_max(scores):
+    '''
+    Scale the scored documents to [0, 1], 0 for documents without a score
+    '''
+    valid = ~np.isnan(scores)
+    normalized = np.zeros(len(scores))
+    if not valid.any():
+        return normalized
+    low, high = np.min(scores[valid]), np.max(scores[valid])
+    normalized[valid] = (scores[valid] - low) / (high - low) if high > low else 1
+    return normalized
+
+
+def rrf(signals, weights, rrf_k=60):
+    return sum(weights.get(name, 1) * reciprocal_ranks(scores, rrf_k) for name, scores in signals.items())
+
+
+def weighted_sum(signals, weights, rrf_k=None):
+    return sum(weights.get(name, 1) * min_max(scores) for name, scores in signals.items())
+
+
+FUSION_STRATEGIES = {'rrf': rrf, 'weighted': weighted_sum}
+
+
+def fuse(signals, strategy='rrf', weights=None, rrf_k=60):
+    '''
+    Combine score arrays indexed by doc id in one vectorised pass
+    :param signals: {name: array}, higher is better, NaN where the signal did not score the document
+    :param strategy: 'rrf' (reciprocal rank fusion) or 'weighted' (weighted sum of min-max normalised scores)
+    :param weights: {name: weight}, 1 for missing names
+    :param rrf_k: rank offset of reciprocal rank fusion
+    :return: fused scores, NaN for documents no signal scored
+    '''
+    signals = {name: scores for name, scores in signals.items() if scores is not None}
+    fused = FUSION_STRATEGIES[strategy](signals, weights or {}, rrf_k=rrf_k)
+    scored = np.zeros(len(fused), dtype=bool)
+    for scores in signals.values():
+        scored |= ~np.isnan(scores)
+    fused[~scored] = np.nan
+    return fused
+
+
+def top_k(scores, k):
+    '''
+    :param scores:
+    :param k:
+    :return: doc ids of the k highest scores, best first, ignoring NaN. Ties keep doc id order
+    '''
+    valid = np.flatnonzero(~np.isnan(scores))
+    k = min(k, len(valid))
+    if k == 0:
+        return valid
+    best = valid[np.argpartition(-scores[valid], k - 1)[:k]]
+    # argpartition does not keep doc id order among equal scores at the boundary
+    threshold = np.min(scores[best])
+    best = valid[scores[valid] >= threshold]
+    return best[np.argsort(-scores[best], kind='stable')][:k]
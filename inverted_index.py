@@ -0,0 +1,332 @@
+import os
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class InvertedIndex:
+    """
+    Array backed TF-IDF index.
+
+    Documents are identified by integer ids (their position in ``urls``) and
+    terms by their position in ``terms``. Postings are stored CSR style: the
+    postings of term ``t`` are ``doc_ids[offsets[t]:offsets[t + 1]]`` with the
+    matching tf-idf ``weights``. Every array is saved as a ``.npy`` file so it
+    can be memory-mapped instead of unpickled.
+
+    ``max_scores[t]`` is the largest length normalised weight
+    ``weight / sqrt(doc_length)`` in the postings of term ``t``, an upper bound
+    of the term's contribution to any document's cosine score.
+
+    The raw term frequencies ``tfs`` are kept next to the weights so documents
+    can be added, replaced or deleted: changes are staged with stage_document
+    and delete_document and only applied, with idf and document lengths
+    recomputed, by merge.
+    """
+    array_names = ['offsets', 'doc_ids', 'weights', 'idf', 'doc_lengths', 'max_scores', 'tfs']
+
+    def __init__(self, terms, urls, offsets, doc_ids, weights, idf, doc_lengths, max_scores=None, tfs=None):
+        self.terms = terms
+        self.urls = urls
+        self.term_ids = {term: term_id for term_id, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.idf = idf
+        self.doc_lengths = doc_lengths
+        if max_scores is None:
+            max_scores = self.compute_max_scores()
+        self.max_scores = max_scores
+        if tfs is None:
+            tfs = self.compute_tfs()
+        self.tfs = tfs
+        self.matrix = None
+        self.staged = {}
+        self.deleted = set()
+        self.deleted_ids = np.empty(0, dtype=np.int64)
+
+    @property
+    def num_docs(self):
+        return len(self.urls)
+
+    @property
+    def num_terms(self):
+        return len(self.terms)
+
+    def term_id(self, term):
+        return self.term_ids.get(term)
+
+    def postings(self, term_id):
+        '''
+        :param term_id:
+        :return: (doc_ids, weights) arrays of the term's posting list
+        '''
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ids[start:end], self.weights[start:end]
+
+    def compute_max_scores(self):
+        max_scores = np.zeros(len(self.terms))
+        if len(self.doc_ids) == 0:
+            return max_scores
+        doc_lengths = np.asarray(self.doc_lengths, dtype=np.float64)[self.doc_ids]
+        doc_lengths[doc_lengths == 0] = np.inf
+        normalized = np.asarray(self.weights, dtype=np.float64) / np.sqrt(doc_lengths)
+        non_empty = self.offsets[:-1] < self.offsets[1:]
+        max_scores[non_empty] = np.maximum.reduceat(normalized, self.offsets[:-1][non_empty])
+        return max_scores
+
+    def compute_tfs(self):
+        '''
+        Recover the term frequencies of an index saved without them. Terms
+        with an idf of 0 occur in every document and lost their frequency,
+        they are counted once.
+        '''
+        idf = np.repeat(np.asarray(self.idf, dtype=np.float64), np.diff(self.offsets))
+        tfs = np.ones(len(self.doc_ids), dtype=np.float64)
+        np.divide(self.weights, idf, out=tfs, where=idf > 0)
+        return np.rint(tfs).astype(np.int32)
+
+    def as_matrix(self):
+        '''
+        :return: the postings as a (num_terms x num_docs) scipy csr matrix
+        '''
+        if self.matrix is None:
+            self.matrix = csr_matrix((self.weights, self.doc_ids, self.offsets),
+                                     shape=(self.num_terms, self.num_docs))
+        return self.matrix
+
+    @classmethod
+    def from_postings(cls, terms, urls, term_ids, doc_ids, tfs):
+        '''
+        Build the index from unordered (term_id, doc_id, tf) postings. The
+        same (term, doc) pair may occur several times, its frequencies are
+        summed. Terms without postings are dropped.
+        :param terms:
+        :param urls: document urls, a url's position is its doc id
+        :param term_ids:
+        :param doc_ids:
+        :param tfs:
+        :return:
+        '''
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        tfs = np.asarray(tfs, dtype=np.int64)
+        keys = term_ids * max(len(urls), 1) + doc_ids
+        keys, inverse = np.unique(keys, return_inverse=True)
+        tfs = np.bincount(inverse.ravel(), weights=tfs, minlength=len(keys)).astype(np.int32)
+        term_ids, doc_ids = np.divmod(keys, max(len(urls), 1))
+        df = np.bincount(term_ids, minlength=len(terms))
+        used = np.flatnonzero(df)
+        new_term_ids = np.full(len(terms), -1, dtype=np.int64)
+        new_term_ids[used] = np.arange(len(used))
+        terms = [terms[term_id] for term_id in used]
+        df = df[used]
+        idf = np.log(len(urls) / df)
+        weights = tfs * np.repeat(idf, df)
+        doc_lengths = np.bincount(doc_ids, weights=weights ** 2, minlength=len(urls))
+        offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        return cls(terms, list(urls), offsets, doc_ids.astype(np.int32), weights.astype(np.float32),
+                   idf.astype(np.float32), doc_lengths.astype(np.float32), tfs=tfs)
+
+    def stage_document(self, doc_id, tokens):
+        '''
+        Stage the tokens of a new or changed document, they replace the
+        document's current postings at the next merge
+        :param doc_id:
+        :param tokens:
+        :return:
+        '''
+        self.deleted.discard(doc_id)
+        self.staged[doc_id] = Counter(tokens)
+        self.update_deleted_ids()
+
+    def delete_document(self, doc_id):
+        '''
+        The document is excluded from results at once and its postings are
+        dropped at the next merge
+        :param doc_id:
+        :return:
+        '''
+        self.staged.pop(doc_id, None)
+        self.deleted.add(doc_id)
+        self.update_deleted_ids()
+
+    def update_deleted_ids(self):
+        self.deleted_ids = np.array(sorted(self.deleted), dtype=np.int64)
+
+    @property
+    def has_changes(self):
+        return bool(self.staged or self.deleted)
+
+    def merge(self, urls):
+        '''
+        Apply the staged changes and recompute idf, weights and document
+        lengths. Deleted documents are removed and the remaining doc ids are
+        compacted, keeping their order.
+        :param urls: urls of every doc id, including the deleted ones and the
+        staged documents appended after the current ones
+        :return: (merged index, array mapping old doc ids to new ones, -1 if deleted)
+        '''
+        remap = np.full(len(urls), -1, dtype=np.int64)
+        kept = np.array([doc_id for doc_id in range(len(urls)) if doc_id not in self.deleted], dtype=np.int64)
+        remap[kept] = np.arange(len(kept))
+        posting_terms = np.repeat(np.arange(self.num_terms), np.diff(self.offsets))
+        replaced = np.array(sorted(self.deleted.union(self.staged)), dtype=np.int64)
+        keep = ~np.isin(self.doc_ids, replaced)
+        terms = list(self.terms)
+        term_ids = {term: term_id for term_id, term in enumerate(terms)}
+        staged_terms, staged_docs, staged_tfs = [], [], []
+        for doc_id, counts in self.staged.items():
+            for term, count in counts.items():
+                if term not in term_ids:
+                    term_ids[term] = len(terms)
+                    terms.append(term)
+                staged_terms.append(term_ids[term])
+                staged_docs.append(remap[doc_id])
+                staged_tfs.append(count)
+        index = self.from_postings(terms, [urls[doc_id] for doc_id in kept],
+                                   np.concatenate([posting_terms[keep], staged_terms]),
+                                   np.concatenate([remap[self.doc_ids[keep]], staged_docs]),
+                                   np.concatenate([self.tfs[keep], staged_tfs]))
+        return index, remap
+
+    @classmethod
+    def from_dicts(cls, tf, idf, document_lengths, urls):
+        '''
+        Build the index from the {term: {url: tfidf}} dictionaries produced by
+        SearchEngine.add_to_index / SearchEngine.add_idf
+        :param tf:
+        :param idf:
+        :param document_lengths:
+        :param urls: document urls, a url's position is its doc id
+        :return:
+        '''
+        url_ids = {url: doc_id for doc_id, url in enumerate(urls)}
+        terms = list(tf.keys())
+        num_postings = sum(len(postings) for postings in tf.values())
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        doc_ids = np.empty(num_postings, dtype=np.int32)
+        weights = np.empty(num_postings, dtype=np.float32)
+        start = 0
+        for term_id, term in enumerate(terms):
+            postings = sorted((url_ids[url], tfidf) for url, tfidf in tf[term].items())
+            end = start + len(postings)
+            doc_ids[start:end] = [doc_id for doc_id, _ in postings]
+            weights[start:end] = [tfidf for _, tfidf in postings]
+            offsets[term_id + 1] = end
+            start = end
+        idf = np.array([idf[term] for term in terms], dtype=np.float32)
+        doc_lengths = np.array([document_lengths.get(url, 0) for url in urls], dtype=np.float32)
+        return cls(terms, list(urls), offsets, doc_ids, weights, idf, doc_lengths)
+
+    def save(self, directory):
+        '''
+        Every file is written next to its target and then renamed over it, so
+        an index that memory-maps the old files is not truncated under it
+        :param directory:
+        :return:
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for name in self.array_names:
+            path = os.path.join(directory, f"{name}.npy")
+            with open(path + '.tmp', 'wb') as fptr:
+                np.save(fptr, getattr(self, name))
+            os.replace(path + '.tmp', path)
+        for name, lines in [('terms.txt', self.terms), ('urls.txt', self.urls)]:
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'w', encoding='utf-8') as fptr:
+                fptr.write("\n".join(lines))
+            os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        '''
+        Load an index written by save. With the default mmap_mode the arrays
+        are memory-mapped, so only the term dictionary is read eagerly.
+        :param directory:
+        :param mmap_mode: passed to numpy.load, None reads the arrays into memory
+        :return:
+        '''
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in cls.array_names
+                  if os.path.exists(os.path.join(directory, f"{name}.npy"))}
+        with open(os.path.join(directory, 'terms.txt'), encoding='utf-8') as fptr:
+            terms = fptr.read().split("\n")
+        with open(os.path.join(directory, 'urls.txt'), encoding='utf-8') as fptr:
+            urls = fptr.read().split("\n")
+        if terms == ['']:
+            terms = []
+        if urls == ['']:
+            urls = []
+        return cls(terms, urls, **arrays)
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, 'offsets.npy'))
+
+
+class IndexBuilder:
+    """
+    Collects the postings of documents added one at a time as compact numpy
+    arrays, so the raw text of a document can be dropped once it is added.
+    """
+
+    def __init__(self, flush_size=100000):
+        self.terms = []
+        self.term_ids = {}
+        self.urls = []
+        self.doc_ids = {}
+        self.flush_size = flush_size
+        self.buffer = ([], [], [])
+        self.chunks = []
+
+    def add_document(self, url, tokens):
+        doc_id = len(self.urls)
+        self.urls.append(url)
+        self.doc_ids[url] = doc_id
+        self.add_postings(doc_id, tokens)
+        return doc_id
+
+    def add_tokens(self, url, tokens):
+        '''
+        Add tokens to the document of url, which is added first if it is new.
+        Used to index a page whose text arrives in parts, e.g. anchor texts
+        found on other pages during a crawl.
+        :param url:
+        :param tokens:
+        :return: doc id of the document
+        '''
+        doc_id = self.doc_ids.get(url)
+        if doc_id is None:
+            return self.add_document(url, tokens)
+        self.add_postings(doc_id, tokens)
+        return doc_id
+
+    def add_postings(self, doc_id, tokens):
+        term_ids, doc_ids, tfs = self.buffer
+        for term, count in Counter(tokens).items():
+            if term not in self.term_ids:
+                self.term_ids[term] = len(self.terms)
+                self.terms.append(term)
+            term_ids.append(self.term_ids[term])
+            doc_ids.append(doc_id)
+            tfs.append(count)
+        if len(tfs) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        term_ids, doc_ids, tfs = self.buffer
+        if tfs:
+            self.chunks.append((np.array(term_ids, dtype=np.int32),
+                                np.array(doc_ids, dtype=np.int32),
+                                np.array(tfs, dtype=np.int32)))
+        self.buffer = ([], [], [])
+
+    def build(self):
+        self.flush()
+        if not self.chunks:
+            self.chunks = [(np.empty(0, dtype=np.int32),) * 3]
+        term_ids, doc_ids, tfs = (np.concatenate(arrays) for arrays in zip(*self.chunks))
+        self.chunks = []
+        return InvertedIndex.from_postings(self.terms, self.urls, term_ids, doc_ids, tfs)
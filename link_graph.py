@@ -0,0 +1,139 @@
+import os
+import pickle
+import sys
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class LinkGraph:
+    """
+    Compact link graph.
+
+    Pages are identified by int32 node ids, node ``i`` being the page
+    ``urls[i]``. Links are stored twice in CSR form: the out links of node
+    ``u`` are ``out_targets[out_offsets[u]:out_offsets[u + 1]]`` and its in
+    links are ``in_sources[in_offsets[u]:in_offsets[u + 1]]``. Every array is
+    saved as a ``.npy`` file so it can be memory-mapped, the urls as a text
+    file with one url per line.
+    """
+    array_names = ['out_offsets', 'out_targets', 'in_offsets', 'in_sources']
+
+    def __init__(self, urls, out_offsets, out_targets, in_offsets, in_sources):
+        self.urls = urls
+        self.node_ids = {url: node for node, url in enumerate(urls)}
+        self.out_offsets = out_offsets
+        self.out_targets = out_targets
+        self.in_offsets = in_offsets
+        self.in_sources = in_sources
+
+    @property
+    def num_nodes(self):
+        return len(self.urls)
+
+    @property
+    def num_edges(self):
+        return len(self.out_targets)
+
+    def node_id(self, url):
+        return self.node_ids.get(url)
+
+    def out_links(self, node):
+        return self.out_targets[self.out_offsets[node]:self.out_offsets[node + 1]]
+
+    def in_links(self, node):
+        return self.in_sources[self.in_offsets[node]:self.in_offsets[node + 1]]
+
+    def adjacency(self):
+        '''
+        :return: sparse (num_nodes x num_nodes) matrix A with A[child, parent] = 1 for every link
+        '''
+        return csr_matrix((np.ones(self.num_edges), self.in_sources, self.in_offsets),
+                          shape=(self.num_nodes, self.num_nodes))
+
+    @classmethod
+    def from_edges(cls, urls, parents, children):
+        '''
+        :param urls: url of every node
+        :param parents: node id of the source of every link
+        :param children: node id of the target of every link
+        :return: graph with duplicated links kept once
+        '''
+        n = max(len(urls), 1)
+        keys = np.unique(np.asarray(parents, dtype=np.int64) * n + np.asarray(children, dtype=np.int64))
+        parents, children = np.divmod(keys, n)
+        out_offsets = np.concatenate([[0], np.cumsum(np.bincount(parents, minlength=len(urls)))])
+        order = np.lexsort((parents, children))
+        in_offsets = np.concatenate([[0], np.cumsum(np.bincount(children, minlength=len(urls)))])
+        return cls(list(urls), out_offsets.astype(np.int64), children.astype(np.int32),
+                   in_offsets.astype(np.int64), parents[order].astype(np.int32))
+
+    @classmethod
+    def from_pickles(cls, url_keys_file, link_graph_file):
+        '''
+        Convert the crawler's {url: md5} and [(parent md5, child md5)] pickles.
+        Pages only known by their md5 get an empty url.
+        :param url_keys_file:
+        :param link_graph_file:
+        :return:
+        '''
+        with open(url_keys_file, 'rb') as fptr:
+            url_to_keys = pickle.load(fptr)
+        with open(link_graph_file, 'rb') as fptr:
+            graph = pickle.load(fptr)
+        node_ids, urls = {}, []
+        for url, key in url_to_keys.items():
+            if key not in node_ids:
+                node_ids[key] = len(urls)
+                urls.append(url)
+        parents = np.empty(len(graph), dtype=np.int64)
+        children = np.empty(len(graph), dtype=np.int64)
+        for i, (p, c) in enumerate(graph):
+            for nodes, key in [(parents, p), (children, c)]:
+                if key not in node_ids:
+                    node_ids[key] = len(urls)
+                    urls.append("")
+                nodes[i] = node_ids[key]
+        return cls.from_edges(urls, parents, children)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.array_names:
+            path = os.path.join(directory, f"{name}.npy")
+            with open(path + '.tmp', 'wb') as fptr:
+                np.save(fptr, getattr(self, name))
+            os.replace(path + '.tmp', path)
+        path = os.path.join(directory, 'urls.txt')
+        with open(path + '.tmp', 'w', encoding='utf-8') as fptr:
+            fptr.write("\n".join(self.urls))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        '''
+        :param directory:
+        :param mmap_mode: passed to numpy.load, None reads the arrays into memory
+        :return:
+        '''
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in cls.array_names}
+        with open(os.path.join(directory, 'urls.txt'), encoding='utf-8') as fptr:
+            urls = fptr.read().split("\n")
+        if urls == ['']:
+            urls = []
+        return cls(urls, **arrays)
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, 'out_offsets.npy'))
+
+
+def main():
+    if len(sys.argv) != 4:
+        print("usage: python link_graph.py data/url_keys.pickle data/link_graph.pickle data/link_graph")
+        return
+    LinkGraph.from_pickles(sys.argv[1], sys.argv[2]).save(sys.argv[3])
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,8 @@ class SearchEngineGUI:
             self.engine = SearchEngine()
         except Exception as e:
             self.engine = SearchEngine(fresh_start=True)
+        # load the BERT model while the user types the first query
+        self.engine.warm_up()
 
     def get_main_layout(self):
         main_layout = [[sg.Text('Search Engine', justification='center', size=(70, 1))],
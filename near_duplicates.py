@@ -0,0 +1,83 @@
+import hashlib
+import re
+
+import numpy as np
+
+
+class SimHashIndex:
+    """
+    Near-duplicate detection with SimHash fingerprints.
+
+    A page's fingerprint is the 64 bit SimHash of its word shingles, so
+    pages whose text barely differs get fingerprints a few bits apart. Two
+    pages are near duplicates when their fingerprints differ in at most
+    max_distance bits. The fingerprint is cut into max_distance + 1 bands:
+    two fingerprints that close agree on at least one whole band, so the
+    candidates are found with one dict lookup per band and only they are
+    compared bit by bit.
+    """
+    num_bits = 64
+
+    def __init__(self, max_distance=3, shingle_size=3):
+        '''
+        :param max_distance: largest number of differing bits of near duplicates, 0 only matches identical fingerprints
+        :param shingle_size: number of words per shingle
+        '''
+        self.max_distance = max_distance
+        self.shingle_size = shingle_size
+        num_bands = max_distance + 1
+        bounds = np.linspace(0, self.num_bits, num_bands + 1).astype(int)
+        self.bands = [((1 << int(end - start)) - 1, int(start)) for start, end in zip(bounds[:-1], bounds[1:])]
+        self.tables = [{} for _ in self.bands]
+        self.keys = {}
+
+    def fingerprint(self, text):
+        '''
+        :param text:
+        :return: 64 bit SimHash of the word shingles of text
+        '''
+        words = re.findall(r"\w+", text.lower())
+        size = min(self.shingle_size, len(words)) or 1
+        shingles = {}
+        for i in range(max(len(words) - size + 1, 1)):
+            shingle = " ".join(words[i:i + size])
+            shingles[shingle] = shingles.get(shingle, 0) + 1
+        hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+                           for s in shingles], dtype=np.uint64)
+        bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+        weights = np.array(list(shingles.values()), dtype=np.float64)
+        votes = weights.dot(2 * bits.astype(np.float64) - 1)
+        return int(np.packbits(votes > 0, bitorder='little').view(np.uint64)[0])
+
+    def find(self, fingerprint):
+        '''
+        :param fingerprint:
+        :return: key of an indexed near duplicate of the fingerprint, None if there is none
+        '''
+        for (mask, shift), table in zip(self.bands, self.tables):
+            for candidate in table.get((fingerprint >> shift) & mask, ()):
+                if bin(candidate ^ fingerprint).count("1") <= self.max_distance:
+                    return self.keys[candidate]
+        return None
+
+    def add(self, key, fingerprint):
+        if fingerprint in self.keys:
+            return
+        self.keys[fingerprint] = key
+        for (mask, shift), table in zip(self.bands, self.tables):
+            table.setdefault((fingerprint >> shift) & mask, []).append(fingerprint)
+
+    def add_if_unique(self, key, text):
+        '''
+        :param key: identifies the page, usually its url
+        :param text:
+        :return: True if text has no near duplicate yet, it is then indexed under key
+        '''
+        fingerprint = self.fingerprint(text)
+        if self.find(fingerprint) is not None:
+            return False
+        self.add(key, fingerprint)
+        return True
+
+    def __len__(self):
+        return len(self.keys)
@@ -1,51 +1,253 @@
-import pickle
+from collections import deque, namedtuple
 
 import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+from link_graph import LinkGraph
+from resources import shared_resource
+
+PageRankResult = namedtuple('PageRankResult', ['scores', 'iterations', 'residual'])
+
+
+def solve(M, P, alpha=0.2, tol=1e-6, max_iterations=100, v0=None):
+    '''
+    Personalised PageRank by power iteration, v = (1 - alpha) M v + p, for
+    every column p of P at once: each step is one sparse matrix - dense
+    matrix product.
+    :param M: sparse column normalised (n x n) transition matrix
+    :param P: (n,) personalisation vector or (n x q) matrix of them
+    :param alpha: teleport weight
+    :param tol: stop once the largest L1 change of a column is below tol, None always runs max_iterations
+    :param max_iterations:
+    :param v0: starting vectors, uniform by default
+    :return: PageRankResult(scores shaped like P, iterations run, final residual)
+    '''
+    P = np.asarray(P, dtype=np.float64)
+    V = np.full(P.shape, 1 / max(len(P), 1)) if v0 is None else np.asarray(v0, dtype=np.float64)
+    iterations, residual = 0, np.inf
+    while iterations < max_iterations:
+        V2 = (1 - alpha) * M.dot(V) + P
+        residual = float(np.max(np.abs(V2 - V).sum(axis=0))) if V.size else 0.0
+        V = V2
+        iterations += 1
+        if tol is not None and residual < tol:
+            break
+    return PageRankResult(V, iterations, residual)
+
+
+def forward_push(offsets, targets, seeds, alpha=0.2, epsilon=1e-4):
+    '''
+    Approximate personalised PageRank of the same recurrence as solve by
+    local forward push. Every node holds an estimate and a residual, starting
+    from the seed scores as residual; a node whose residual is at least
+    epsilon times its out degree moves it to its estimate and spreads
+    (1 - alpha) of it evenly over its out links. Only nodes reached by a push
+    are touched, the number of pushes is bounded by sum(seeds) / (alpha * epsilon)
+    whatever the size of the graph.
+    :param offsets: CSR offsets of the out links, node u links to targets[offsets[u]:offsets[u + 1]]
+    :param targets:
+    :param seeds: {node: score}
+    :param alpha: teleport weight
+    :param epsilon: residual per out link left unpushed, larger is faster and coarser
+    :return: PageRankResult({node: estimate}, number of pushes, residual mass left)
+    '''
+    estimates = {}
+    residuals = dict(seeds)
+    queue = deque(residuals)
+    queued = set(queue)
+    pushes = 0
+    while queue:
+        u = queue.popleft()
+        queued.discard(u)
+        r = residuals[u]
+        start, end = offsets[u], offsets[u + 1]
+        if r < epsilon * max(end - start, 1):
+            continue
+        pushes += 1
+        estimates[u] = estimates.get(u, 0) + r
+        residuals[u] = 0
+        if end == start:
+            continue
+        share = (1 - alpha) * r / (end - start)
+        for v in targets[start:end].tolist():
+            residuals[v] = residuals.get(v, 0) + share
+            if v not in queued and residuals[v] >= epsilon * max(offsets[v + 1] - offsets[v], 1):
+                queue.append(v)
+                queued.add(v)
+    return PageRankResult(estimates, pushes, sum(residuals.values()))
+
+
+def column_normalize(M):
+    s = np.asarray(M.sum(axis=0)).ravel()
+    s[s == 0] = 1
+    return M.dot(diags(1 / s)).tocsr()
 
 
 class TSPageRank:
     """
     This is an implementation of topic specific page rank
     """
-    url_to_keys = pickle.load(open('data/url_keys.pickle', 'rb'))
-    graph = pickle.load(open('data/link_graph.pickle', 'rb'))
+    url_keys_file = 'data/url_keys.pickle'
+    link_graph_file = 'data/link_graph.pickle'
+    link_graph_dir = 'data/link_graph'
+    topics_file = 'data/topic_pageranks.npz'
 
-    def __init__(self, num_iterations=20, alpha=0.2):
+    def __init__(self, num_iterations=20, alpha=0.2, tol=None, mode='subgraph', epsilon=1e-4):
+        '''
+        :param num_iterations: iteration cap of the solver
+        :param alpha:
+        :param tol: residual at which the solver stops, None runs num_iterations
+        :param mode: 'subgraph' solves on the links among the given urls only,
+        'push' approximates by forward push over the whole link graph
+        :param epsilon: residual bound of the push mode
+        '''
         self.num_iterations = num_iterations
         self.alpha = alpha
+        self.tol = tol
+        self.mode = mode
+        self.epsilon = epsilon
+        self.last_result = None
+
+    @shared_resource
+    def link_graph(cls):
+        '''
+        The memory-mapped link graph, converted once from the crawler's pickles
+        by precompute
+        '''
+        if not LinkGraph.exists(cls.link_graph_dir):
+            cls.precompute()
+        return LinkGraph.load(cls.link_graph_dir)
+
+    @shared_resource
+    def adjacency(cls):
+        '''
+        Sparse adjacency matrix of the whole link graph with A[child, parent] = 1
+        for every link
+        '''
+        return cls.link_graph.adjacency()
+
+    @classmethod
+    def precompute(cls):
+        '''
+        Offline stage: convert url_keys_file and link_graph_file to the
+        compact format in link_graph_dir
+        :return:
+        '''
+        graph = LinkGraph.from_pickles(cls.url_keys_file, cls.link_graph_file)
+        graph.save(cls.link_graph_dir)
+        return graph
 
     def create_matrix(self, urls):
-        M = np.empty(shape=[len(urls), len(urls)])
-        keys = []
-        for u in urls:
-            if u not in self.url_to_keys:
-                keys.append("NAN")
-                continue
-            key = self.url_to_keys[u]
-            keys.append(key)
-        for p, c in self.graph:
-            if p not in keys or c not in keys:
-                continue
-            c = keys.index(c)
-            p = keys.index(p)
-            M.itemset((c, p), 1)
-        for node in range(len(urls)):
-            col = M[:, node]
-            s = np.sum(col)
-            if s > 0:
-                col /= s
-            M[:, node] = col
-        return M
+        '''
+        Column normalised adjacency of the subgraph induced by urls, sliced
+        out of the precomputed sparse matrix
+        :param urls:
+        :return: sparse (len(urls) x len(urls)) matrix
+        '''
+        A = self.adjacency
+        node_ids = self.link_graph.node_ids
+        nodes = np.array([node_ids.get(u, -1) for u in urls], dtype=np.int64)
+        # a node listed twice only gets the edges of its first position
+        _, first = np.unique(nodes, return_index=True)
+        rows = np.zeros(len(urls), dtype=bool)
+        rows[first] = True
+        rows &= nodes >= 0
+        positions = np.flatnonzero(rows)
+        sub = A[nodes[positions]][:, nodes[positions]].tocoo()
+        M = csr_matrix((sub.data, (positions[sub.row], positions[sub.col])), shape=(len(urls), len(urls)))
+        return column_normalize(M)
 
     def get_pageranks(self, urls_to_scores):
+        if self.mode == 'push':
+            return self.push_pageranks(urls_to_scores)
         urls = list(urls_to_scores.keys())
         M = self.create_matrix(urls)
-        v = [1 / len(urls_to_scores) for _ in urls_to_scores]
         p_hat = np.array(list(urls_to_scores.values()))
-        for _ in range(self.num_iterations):
-            # print(v)
-            v2 = M.dot(v)
-            v2 = (1 - self.alpha) * v2
-            v = v2 + p_hat
-        pgscores = list(zip(urls, v))
+        self.last_result = solve(M, p_hat, self.alpha, self.tol, self.num_iterations)
+        pgscores = list(zip(urls, self.last_result.scores))
         return sorted(pgscores, key=lambda x: x[1], reverse=True)
+
+    def push_pageranks(self, urls_to_scores):
+        '''
+        Forward push seeded with the candidate scores. Besides the candidates,
+        pages of the wider link graph reached by the push are returned.
+        Candidates missing from the graph keep their seed score.
+        :param urls_to_scores:
+        :return: [(url, score)] sorted by score
+        '''
+        graph = self.link_graph
+        seeds, scores = {}, {}
+        for url, score in urls_to_scores.items():
+            node = graph.node_id(url)
+            if node is None:
+                scores[url] = score
+            else:
+                seeds[node] = seeds.get(node, 0) + score
+        self.last_result = forward_push(graph.out_offsets, graph.out_targets, seeds, self.alpha, self.epsilon)
+        for node, score in self.last_result.scores.items():
+            url = graph.urls[node]
+            if url:
+                scores[url] = score
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+    @shared_resource
+    def transition(cls):
+        '''
+        Column normalised adjacency of the whole link graph
+        '''
+        return column_normalize(cls.adjacency)
+
+    def personalization_matrix(self, topics):
+        '''
+        :param topics: list of {url: weight} dicts
+        :return: (num_nodes x len(topics)) matrix, urls outside the graph are ignored
+        '''
+        graph = self.link_graph
+        P = np.zeros((graph.num_nodes, len(topics)))
+        for column, urls_to_scores in enumerate(topics):
+            for url, score in urls_to_scores.items():
+                node = graph.node_id(url)
+                if node is not None:
+                    P[node, column] += score
+        return P
+
+    def global_pageranks(self, topics):
+        '''
+        Personalised PageRank of several topics over the whole link graph,
+        solved together
+        :param topics: list of {url: weight} dicts
+        :return: PageRankResult with a (num_nodes x len(topics)) score matrix
+        '''
+        P = self.personalization_matrix(topics)
+        return solve(self.transition, P, self.alpha, self.tol, self.num_iterations)
+
+    def precompute_topics(self, topics):
+        '''
+        Offline stage: solve and save the PageRank vectors of common topics or
+        query clusters
+        :param topics: {name: {url: weight}}
+        :return: PageRankResult of the solve
+        '''
+        names = list(topics)
+        result = self.global_pageranks([topics[name] for name in names])
+        np.savez(self.topics_file, names=np.array(names), scores=result.scores.astype(np.float32),
+                 iterations=result.iterations, residual=result.residual)
+        return result
+
+    def topic_pageranks(self, name):
+        '''
+        :param name: a topic saved by precompute_topics
+        :return: {url: score} of the topic
+        '''
+        saved = np.load(self.topics_file)
+        column = list(saved['names']).index(name)
+        scores = saved['scores'][:, column]
+        return {url: float(score) for url, score in zip(self.link_graph.urls, scores) if url}
+
+
+def main():
+    TSPageRank.precompute()
+
+
+if __name__ == '__main__':
+    main()
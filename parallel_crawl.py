@@ -0,0 +1,418 @@
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import time
+from urllib.parse import urldefrag, urljoin, urlparse
+
+import requests
+
+from crawl_store import CrawlStore
+from crawler import IGNORED_EXTENSIONS
+from extraction import ContentExtractor
+from frontier import EdgeStore
+from link_graph import LinkGraph
+from near_duplicates import SimHashIndex
+from politeness import PolitenessScheduler
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s:%(message)s',
+    level=logging.INFO)
+
+# states of a url in the shared frontier
+QUEUED, LEASED, DONE = 0, 1, 2
+
+
+class SharedFrontier:
+    """
+    Crawl frontier and seen set of the worker processes, in a SQLite
+    database in WAL mode so readers never wait for the writer.
+
+    Every url ever queued is a row of the urls table, which is the seen
+    set. A worker leases urls in a BEGIN IMMEDIATE transaction, which takes
+    the database's single write lock, so no url is handed to two workers.
+    A lease expires after lease_seconds: the urls of a worker that died are
+    leased again to the others. A worker renews the lease of a url right
+    before fetching it, and skips it if it was leased to another worker
+    meanwhile, so a slow batch is never fetched twice. Urls are leased in
+    the order they were queued, breadth first, until max_pages of them were
+    leased.
+
+    The SimHash fingerprints of the kept pages are shared the same way,
+    one row per band as in near_duplicates.SimHashIndex, so a page is only
+    kept if no worker kept a near duplicate of it.
+    """
+
+    def __init__(self, path, max_pages=5000, lease_seconds=60, timeout=60):
+        '''
+        :param path: SQLite database, created if it does not exist
+        :param max_pages: most urls leased in the whole crawl
+        :param lease_seconds: seconds after which a leased url not finished is leased again
+        :param timeout: seconds to wait for the write lock
+        '''
+        self.max_pages = max_pages
+        self.lease_seconds = lease_seconds
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.transaction():
+            self.connection.execute('CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, url TEXT UNIQUE, '
+                                    'state INTEGER DEFAULT 0, worker INTEGER, expires REAL, status INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS urls_state ON urls (state, id)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                                    '(band INTEGER, value INTEGER, fingerprint INTEGER, url TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fingerprints_band ON fingerprints (band, value)')
+            # number of urls leased from the queue, to stop at max_pages
+            self.connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            self.connection.execute("INSERT OR IGNORE INTO counters VALUES ('leased', 0)")
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def add(self, urls):
+        '''
+        Queue the urls not seen before
+        '''
+        with self.transaction():
+            self.connection.executemany('INSERT OR IGNORE INTO urls (url) VALUES (?)', ((url,) for url in urls))
+
+    def lease(self, worker, count=1):
+        '''
+        :param worker: number of the worker
+        :param count: most urls to lease
+        :return: urls leased to the worker, expired leases first, [] if none is free
+        '''
+        now = time.time()
+        with self.transaction():
+            rows = self.connection.execute('SELECT id, url FROM urls WHERE state = ? AND expires < ? LIMIT ?',
+                                           (LEASED, now, count)).fetchall()
+            leased = self.connection.execute("SELECT value FROM counters WHERE name = 'leased'").fetchone()[0]
+            room = min(count - len(rows), self.max_pages - leased)
+            if room > 0:
+                queued = self.connection.execute('SELECT id, url FROM urls WHERE state = ? ORDER BY id LIMIT ?',
+                                                 (QUEUED, room)).fetchall()
+                self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'leased'", (len(queued),))
+                rows += queued
+            self.connection.executemany('UPDATE urls SET state = ?, worker = ?, expires = ? WHERE id = ?',
+                                        ((LEASED, worker, now + self.lease_seconds, row[0]) for row in rows))
+        return [url for _, url in rows]
+
+    def renew(self, worker, url, seconds):
+        '''
+        :param worker: number of the worker
+        :param url: url leased to the worker
+        :param seconds: the lease expires this many seconds from now
+        :return: False if the url is no longer leased to the worker
+        '''
+        with self.transaction():
+            return self.connection.execute('UPDATE urls SET expires = ? WHERE url = ? AND state = ? AND worker = ?',
+                                           (time.time() + seconds, url, LEASED, worker)).rowcount == 1
+
+    def finish(self, worker, url, status):
+        '''
+        :param worker: number of the worker
+        :param status: http status of the url, None if it could not be fetched
+        '''
+        with self.transaction():
+            self.connection.execute('UPDATE urls SET state = ?, status = ? WHERE url = ? AND worker = ?',
+                                    (DONE, status, url, worker))
+
+    def pending(self):
+        '''
+        :return: True while a url is leased, whose page may queue more, or one can still be leased
+        '''
+        if self.connection.execute('SELECT 1 FROM urls WHERE state = ? LIMIT 1', (LEASED,)).fetchone():
+            return True
+        leased = self.connection.execute("SELECT value FROM counters WHERE name = 'leased'").fetchone()[0]
+        return leased < self.max_pages and bool(
+            self.connection.execute('SELECT 1 FROM urls WHERE state = ? LIMIT 1', (QUEUED,)).fetchone())
+
+    def release_all(self):
+        '''
+        Queue again the urls leased by the workers of an interrupted crawl
+        '''
+        with self.transaction():
+            released = self.connection.execute('UPDATE urls SET state = ?, worker = NULL WHERE state = ?',
+                                               (QUEUED, LEASED)).rowcount
+            self.connection.execute("UPDATE counters SET value = value - ? WHERE name = 'leased'", (released,))
+
+    def claim_fingerprint(self, url, fingerprint, duplicates):
+        '''
+        :param url:
+        :param fingerprint: SimHash of the page
+        :param duplicates: SimHashIndex giving the bands and the largest distance of near duplicates
+        :return: url of a near duplicate kept before, url itself if it was kept before, None if the
+        page has none and is now kept
+        '''
+        keys = [(band, (fingerprint >> shift) & mask) for band, (mask, shift) in enumerate(duplicates.bands)]
+        with self.transaction():
+            for band, value in keys:
+                for candidate, original in self.connection.execute(
+                        'SELECT fingerprint, url FROM fingerprints WHERE band = ? AND value = ?', (band, value)):
+                    # SQLite integers are signed
+                    if bin((candidate & 0xFFFFFFFFFFFFFFFF) ^ fingerprint).count("1") <= duplicates.max_distance:
+                        return original
+            signed = fingerprint - (1 << 64) if fingerprint >> 63 else fingerprint
+            self.connection.executemany('INSERT INTO fingerprints VALUES (?, ?, ?, ?)',
+                                        ((band, value, signed, url) for band, value in keys))
+        return None
+
+    def close(self):
+        self.connection.close()
+
+
+class Transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT, rolled back if the block raises
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, kind, value, traceback):
+        self.connection.execute('COMMIT' if kind is None else 'ROLLBACK')
+        return False
+
+
+class CrawlWorker:
+    """
+    One crawl process. It leases urls from the shared frontier, fetches and
+    parses them as the Scrapy spider does, and appends pages, anchor texts
+    and links to its own crawl store shard. Parsing is what keeps a crawler
+    busy, so throughput grows with the number of workers.
+    """
+    filter_file = "WebCrawl/spiders/data_filter.txt"
+    allowed_domain = "uic.edu"
+
+    def __init__(self, worker, frontier_file, shard_dir, max_pages=5000, max_distance=3, politeness=None,
+                 batch_size=4, timeout=15, poll_interval=0.2):
+        '''
+        :param worker: number of the worker, names its shard
+        :param frontier_file: SQLite database of the SharedFrontier
+        :param shard_dir: directory of the crawl store shards
+        :param max_pages: most pages of the whole crawl
+        :param max_distance: pages whose SimHash fingerprints differ in at most this many bits are duplicates
+        :param politeness: PolitenessScheduler of this worker
+        :param batch_size: urls leased at once
+        :param timeout: seconds to wait for a response
+        :param poll_interval: seconds to wait when every queued url is leased to other workers
+        '''
+        self.worker = worker
+        self.frontier = SharedFrontier(frontier_file, max_pages)
+        self.store = CrawlStore(os.path.join(shard_dir, f"worker-{worker:03d}"))
+        self.duplicates = SimHashIndex(max_distance)
+        self.politeness = politeness or PolitenessScheduler()
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        with open(self.filter_file) as fptr:
+            filter_text = fptr.readlines()
+        self.extractor = ContentExtractor(filter_text, self.clean_text,
+                                          class_pattern='(title|description|text|quote|course|intro|content)',
+                                          container_tags=('div', 'section', 'span'))
+        self.count = 0
+
+    def run(self):
+        while True:
+            urls = self.frontier.lease(self.worker, self.batch_size)
+            if not urls:
+                if not self.frontier.pending():
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            for url in urls:
+                # robots.txt, the politeness wait and the request itself, each request taking at most timeout
+                if not self.frontier.renew(self.worker, url, 2 * self.timeout + self.politeness.longest_wait(url)):
+                    continue
+                status = None
+                try:
+                    status = self.crawl(url)
+                except Exception:
+                    logging.exception(f'Failed to crawl: {url}')
+                self.frontier.finish(self.worker, url, status)
+        self.store.close()
+        self.frontier.close()
+        logging.info(f'Worker {self.worker} kept {self.count} pages')
+
+    def fetch_robots(self, url):
+        robots_url = self.politeness.needs_robots(url)
+        if robots_url is None:
+            return
+        try:
+            response = requests.get(robots_url, timeout=self.timeout)
+            text = response.text if response.status_code == 200 else ""
+        except requests.RequestException:
+            text = ""
+        self.politeness.set_robots(url, text)
+
+    def download(self, url):
+        self.fetch_robots(url)
+        self.politeness.wait(url)
+        start = time.monotonic()
+        try:
+            response = requests.get(url, timeout=self.timeout)
+        except requests.RequestException:
+            self.politeness.release(url, time.monotonic() - start, None)
+            raise
+        self.politeness.release(url, time.monotonic() - start, response.status_code, len(response.content))
+        return response
+
+    def crawl(self, url):
+        '''
+        :return: http status of the url
+        '''
+        response = self.download(url)
+        self.store.add_crawled(url)
+        if response.status_code != 200 or 'html' not in response.headers.get('Content-Type', 'text/html'):
+            return response.status_code
+        logging.info(f'Worker {self.worker} {self.count}) Crawling: {url}')
+        page = self.extractor.parse(response.text)
+        body = self.extractor.body(page)
+        fingerprint = self.duplicates.fingerprint(self.extractor.fingerprint_text(page, body))
+        original = self.frontier.claim_fingerprint(url, fingerprint, self.duplicates)
+        if original is not None and original != url:
+            logging.info(f'Near duplicate of {original}: {url}')
+            return response.status_code
+        self.count += 1
+        self.store.add_page(url, self.get_title(page), body, fingerprint)
+        children = []
+        for link in page.links:
+            child = self.linked_url(url, link.href)
+            if child is None:
+                continue
+            content = self.clean_text(link.text.lower()) if isinstance(link.text, str) else ""
+            if content and self.extractor.keep_anchor(content):
+                self.store.add_anchor(child, content)
+            self.store.add_edge(url, child)
+            children.append(child)
+        self.frontier.add(children)
+        return response.status_code
+
+    def linked_url(self, url, href):
+        '''
+        :return: absolute url of a link of the page at url, None if it is not crawled
+        '''
+        if not href:
+            return None
+        path = urldefrag(urljoin(url, href))[0]
+        if path[-4:] in IGNORED_EXTENSIONS or self.allowed_domain not in urlparse(path).netloc:
+            return None
+        return path
+
+    @staticmethod
+    def clean_text(text: str):
+        text = re.sub(r"[^a-zA-Z0-9 -,.&\"%$@()]", " ", text)
+        text = re.sub(r"\s+", " ", text)
+        return text.strip()
+
+    @staticmethod
+    def get_title(page):
+        if page.title is None:
+            return ""
+        return re.sub(r"\s+", " ", page.title).strip()
+
+
+def run_worker(worker, frontier_file, shard_dir, max_pages, rate, max_rate, workers):
+    CrawlWorker(worker, frontier_file, shard_dir, max_pages,
+                politeness=PolitenessScheduler(rate=rate, max_rate=max_rate, workers=workers)).run()
+
+
+def txt_md5(txt):
+    return hashlib.md5(txt.encode('utf-8')).hexdigest()
+
+
+def merge_shards(shard_dir, data_file="data/data.pickle", link_graph_file="data/link_graph.pickle",
+                 url_keys_file="data/url_keys.pickle", link_graph_dir="data/link_graph"):
+    '''
+    Merge the crawl store shards of the workers into the files the Scrapy
+    spider writes: data.pickle {url: {'atext', 'body', 'title'}},
+    link_graph.pickle [(parent md5, child md5)] and url_keys.pickle
+    {url: md5}, and the memory-mappable link graph of pageRank.py
+    :param shard_dir: directory of the shards
+    :return: number of documents
+    '''
+    documents = {}
+    edges = EdgeStore()
+    for name in sorted(os.listdir(shard_dir)):
+        path = os.path.join(shard_dir, name)
+        if not CrawlStore.exists(path):
+            continue
+        state = CrawlStore(path).state
+        for url, document in state.documents.items():
+            merged = documents.setdefault(url, {'title': None, 'anchors': {}, 'body': ""})
+            # a page crawled again after its worker died is in two shards, with the same text
+            if url in state.fingerprints:
+                merged['title'], merged['body'] = document['title'], document['body']
+            merged['anchors'].update(document['anchors'])
+        for edge in state.edges:
+            edges.add(edge)
+    data = collections.OrderedDict()
+    for url, document in documents.items():
+        data[url] = {"atext": " . ".join(document['anchors']),
+                     "body": document['body'],
+                     "title": document['title'] or ""}
+    url_keys = collections.OrderedDict((url, txt_md5(url)) for url in documents)
+    for parent, child in edges:
+        for url in [parent, child]:
+            if url not in url_keys:
+                url_keys[url] = txt_md5(url)
+    with open(data_file, 'wb') as fptr:
+        pickle.dump(data, fptr)
+    with open(link_graph_file, 'wb') as fptr:
+        pickle.dump([(url_keys[parent], url_keys[child]) for parent, child in edges], fptr)
+    with open(url_keys_file, 'wb') as fptr:
+        pickle.dump(url_keys, fptr)
+    LinkGraph.from_pickles(url_keys_file, link_graph_file).save(link_graph_dir)
+    return len(data)
+
+
+def crawl(seeds, workers=None, max_pages=5000, directory="data/parallel", rate=2.0, max_rate=16.0):
+    '''
+    Crawl with several worker processes sharing a SQLite frontier, then
+    merge their shards. An interrupted crawl continues where it stopped
+    when started again with the same directory.
+    :param seeds: seed urls
+    :param workers: number of worker processes, one per core by default
+    :param max_pages:
+    :param directory: holds the frontier database and the shards
+    :param rate: initial requests per second to a host, shared by the workers
+    :param max_rate: largest requests per second to a host, shared by the workers
+    :return: number of documents
+    '''
+    workers = workers or os.cpu_count()
+    os.makedirs(directory, exist_ok=True)
+    frontier_file = os.path.join(directory, 'frontier.sqlite')
+    shard_dir = os.path.join(directory, 'shards')
+    frontier = SharedFrontier(frontier_file, max_pages)
+    frontier.release_all()
+    frontier.add(seeds)
+    frontier.close()
+    # every worker paces its own requests, so each gets a share of the rates and crawl-delay of a host
+    processes = [multiprocessing.Process(target=run_worker, args=(worker, frontier_file, shard_dir, max_pages,
+                                                                  rate, max_rate, workers))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return merge_shards(shard_dir)
+
+
+def main():
+    # python parallel_crawl.py [workers] [max_pages]
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    max_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    crawl(['https://cs.uic.edu/'], workers=workers, max_pages=max_pages)
+
+
+if __name__ == '__main__':
+    main()
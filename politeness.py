@@ -0,0 +1,278 @@
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+
+def healthy(status):
+    '''
+    :param status: http status of a response, None if the request failed
+    :return: False if the host failed, is overloaded or asks to slow down
+    '''
+    return status is not None and status < 500 and status != 429
+
+
+def crawl_delay(text, user_agent='*'):
+    '''
+    urllib.robotparser only reads whole seconds, so the Crawl-delay lines are read here
+    :param text: content of a robots.txt
+    :param user_agent:
+    :return: seconds the group of user_agent, or else the * group, asks to wait between requests, None if it does not
+    '''
+    delays = {}
+    agents, in_rules = [], False
+    for line in text.splitlines():
+        line = line.split('#', 1)[0]
+        if ':' not in line:
+            continue
+        field, value = (part.strip() for part in line.split(':', 1))
+        field = field.lower()
+        if field == 'user-agent':
+            if in_rules:
+                agents, in_rules = [], False
+            agents.append(value.lower())
+            continue
+        in_rules = True
+        if field == 'crawl-delay':
+            try:
+                delay = float(value)
+            except ValueError:
+                continue
+            for agent in agents:
+                delays.setdefault(agent, delay)
+    name = user_agent.split('/')[0].lower()
+    for agent, delay in delays.items():
+        if agent != '*' and agent in name:
+            return delay
+    return delays.get('*')
+
+
+class HostPolicy:
+    """
+    Scheduling state and statistics of one host
+    """
+
+    def __init__(self, rate, burst, concurrency, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled = now
+        self.concurrency = concurrency
+        self.active = 0
+        self.latency = None
+        self.crawl_delay = None
+        self.robots_requested = False
+        self.requests = 0
+        self.responses = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_latency = 0.0
+        self.first = None
+        self.last = None
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+
+class PolitenessScheduler:
+    """
+    Per host politeness for the crawlers.
+
+    Every host has a token bucket: a request takes a token, tokens come
+    back at the host's rate up to burst of them. Its number of requests in
+    flight is limited by a concurrency that adapts to the host by additive
+    increase, multiplicative decrease: each healthy response faster than
+    target_latency raises the concurrency by 1 / concurrency (about one per
+    round of requests) and the rate by a rate_growth fraction, a response
+    slower than target_latency lowers the concurrency by a quarter, and an
+    error, 5xx or 429 halves both. A crawl-delay in the host's robots.txt caps its rate
+    at one request per crawl-delay seconds, one at a time.
+
+    When workers processes crawl the same hosts, each with its own
+    scheduler, every scheduler gets 1 / workers of a host's rates and of
+    its crawl-delay cap, so together they keep to the budget of one.
+
+    Crawlers call acquire (or wait, wait_async) before a request and
+    release after it. The Scrapy downloader schedules its own requests, so
+    WebCrawl.middlewares.PolitenessMiddleware only reports responses with
+    record and copies rate and concurrency to the download slots.
+    """
+
+    def __init__(self, rate=2.0, max_rate=16.0, burst=2, rate_growth=0.1, concurrency=2, max_concurrency=8,
+                 target_latency=1.0, user_agent='*', poll_interval=0.05, workers=1):
+        '''
+        :param rate: initial requests per second to a host
+        :param max_rate: largest requests per second to a host
+        :param burst: number of requests a host can get at once after being idle
+        :param rate_growth: fraction of the rate added by a fast healthy response
+        :param concurrency: initial requests in flight to a host
+        :param max_concurrency: largest requests in flight to a host
+        :param target_latency: seconds, slower responses reduce the concurrency
+        :param user_agent: whose crawl-delay is read from robots.txt
+        :param poll_interval: seconds to wait when a host has no free concurrency
+        :param workers: number of processes sharing the rates of a host, each pacing with its own scheduler
+        '''
+        self.workers = workers
+        self.initial_rate = rate / workers
+        self.max_rate = max_rate / workers
+        self.min_rate = self.initial_rate / 16
+        self.burst = burst
+        self.rate_growth = rate_growth
+        self.initial_concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.user_agent = user_agent
+        self.poll_interval = poll_interval
+        self.hosts = {}
+
+    def host(self, url, now=None):
+        name = urlparse(url).netloc
+        policy = self.hosts.get(name)
+        if policy is None:
+            now = time.monotonic() if now is None else now
+            policy = self.hosts[name] = HostPolicy(self.initial_rate, self.burst, self.initial_concurrency, now)
+        return policy
+
+    def needs_robots(self, url):
+        '''
+        :return: the robots.txt url of the host of url the first time it is asked for, else None
+        '''
+        policy = self.host(url)
+        if policy.robots_requested:
+            return None
+        policy.robots_requested = True
+        parts = urlparse(url)
+        return f"{parts.scheme}://{parts.netloc}/robots.txt"
+
+    def set_robots(self, url, text):
+        '''
+        Apply the crawl-delay of a host's robots.txt
+        :param url: any url of the host
+        :param text: content of its robots.txt, "" if it has none
+        '''
+        delay = crawl_delay(text, self.user_agent)
+        if delay:
+            policy = self.host(url)
+            policy.crawl_delay = delay
+            policy.rate = min(policy.rate, self.delay_rate(policy))
+            policy.burst = policy.tokens = 1
+            policy.concurrency = 1
+
+    def delay_rate(self, policy):
+        '''
+        :return: largest rate of this scheduler allowed by the host's crawl-delay
+        '''
+        return 1 / (policy.crawl_delay * self.workers)
+
+    def longest_wait(self, url):
+        '''
+        :return: most seconds wait can take before a request to the url's host, at its lowest rate
+        '''
+        policy = self.host(url)
+        lowest = min(self.min_rate, self.delay_rate(policy)) if policy.crawl_delay else self.min_rate
+        return 1 / lowest
+
+    def acquire(self, url, now=None):
+        '''
+        Take a token and a concurrency slot of the url's host if both are free
+        :return: 0 if the request may start, else the seconds to wait before asking again
+        '''
+        now = time.monotonic() if now is None else now
+        policy = self.host(url, now)
+        if policy.active >= max(int(policy.concurrency), 1):
+            return self.poll_interval
+        policy.refill(now)
+        if policy.tokens < 1:
+            return (1 - policy.tokens) / policy.rate
+        policy.tokens -= 1
+        policy.active += 1
+        self.started(url, now)
+        return 0
+
+    def started(self, url, now=None):
+        '''
+        Count a request to the url's host
+        '''
+        policy = self.host(url)
+        policy.requests += 1
+        if policy.first is None:
+            policy.first = time.monotonic() if now is None else now
+
+    def wait(self, url):
+        while True:
+            delay = self.acquire(url)
+            if not delay:
+                return
+            time.sleep(delay)
+
+    async def wait_async(self, url):
+        while True:
+            delay = self.acquire(url)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def release(self, url, latency, status, size=0):
+        '''
+        :param url:
+        :param latency: seconds the request took
+        :param status: http status, None if the request failed
+        :param size: bytes received
+        '''
+        policy = self.host(url)
+        policy.active = max(policy.active - 1, 0)
+        self.record(url, latency, status, size)
+
+    def record(self, url, latency, status, size=0):
+        '''
+        Adapt the rate and concurrency of the url's host to a response
+        '''
+        policy = self.host(url)
+        policy.last = time.monotonic()
+        if policy.first is None:
+            policy.first = policy.last
+        policy.responses += 1
+        policy.bytes += size
+        policy.total_latency += latency
+        policy.latency = latency if policy.latency is None else 0.7 * policy.latency + 0.3 * latency
+        max_rate, max_concurrency = self.max_rate, self.max_concurrency
+        if policy.crawl_delay:
+            max_rate, max_concurrency = self.delay_rate(policy), 1
+        if not healthy(status):
+            policy.errors += 1
+            policy.concurrency = max(policy.concurrency / 2, 1)
+            # the floor never lifts a host above the rate its robots.txt allows
+            policy.rate = min(max(policy.rate / 2, self.min_rate), max_rate)
+        elif policy.latency > self.target_latency:
+            policy.concurrency = max(policy.concurrency * 0.75, 1)
+        else:
+            policy.concurrency = min(policy.concurrency + 1 / policy.concurrency, max_concurrency)
+            policy.rate = min(policy.rate * (1 + self.rate_growth), max_rate)
+
+    def stats(self):
+        '''
+        :return: {host: {'requests', 'responses', 'errors', 'bytes', 'pages_per_sec', 'mean_latency',
+        'rate', 'concurrency', 'crawl_delay'}}
+        '''
+        stats = {}
+        for name, policy in self.hosts.items():
+            elapsed = (policy.last - policy.first) if policy.last is not None else 0
+            stats[name] = {'requests': policy.requests,
+                           'responses': policy.responses,
+                           'errors': policy.errors,
+                           'bytes': policy.bytes,
+                           'pages_per_sec': policy.responses / elapsed if elapsed > 0 else None,
+                           'mean_latency': policy.total_latency / policy.responses if policy.responses else None,
+                           'rate': policy.rate,
+                           'concurrency': policy.concurrency,
+                           'crawl_delay': policy.crawl_delay}
+        return stats
+
+    def save_stats(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as fptr:
+            json.dump(self.stats(), fptr, indent=4)
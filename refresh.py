@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+
+# statuses telling that a page no longer exists
+GONE_STATUSES = {404, 410}
+
+
+def content_hash(content):
+    '''
+    :param content: str or bytes of a page
+    :return: md5 hex digest of the content
+    '''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.md5(content).hexdigest()
+
+
+def response_validators(headers, content):
+    '''
+    :param headers: response headers, any mapping with get
+    :param content: body of the response
+    :return: {'etag', 'last_modified', 'hash'} to send back on the next crawl
+    '''
+    return {'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'hash': content_hash(content)}
+
+
+def conditional_headers(validators):
+    '''
+    :param validators: {'etag', 'last_modified', 'hash'} of the previous crawl, None if there is none
+    :return: the If-None-Match and If-Modified-Since headers asking for the page only if it changed
+    '''
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+class Manifest:
+    """
+    Pages a refresh crawl found changed, added or removed since the crawl
+    it refreshes. A page is unchanged when the server answers 304 Not
+    Modified or sends the same content hash again. Pages that answer 404
+    or 410 are removed, and so are the pages of the previous crawl a
+    complete refresh did not reach. Saved as {"changed": [urls], "added":
+    [urls], "removed": [urls]} for SearchEngine.apply_manifest.
+    """
+
+    def __init__(self, previous=()):
+        '''
+        :param previous: urls of the pages of the previous crawl
+        '''
+        self.previous = dict.fromkeys(previous)
+        self.seen = set()
+        self.changed = []
+        self.added = []
+        self.removed = []
+
+    def unchanged(self, url):
+        self.seen.add(url)
+
+    def updated(self, url):
+        if url in self.seen:
+            return
+        self.seen.add(url)
+        if url in self.previous:
+            self.changed.append(url)
+        else:
+            self.added.append(url)
+
+    def gone(self, url):
+        if url in self.seen:
+            return
+        self.seen.add(url)
+        if url in self.previous:
+            self.removed.append(url)
+
+    def finish(self, complete):
+        '''
+        :param complete: the crawl ran out of pages rather than stopping at its page limit
+        '''
+        if complete:
+            for url in self.previous:
+                if url not in self.seen:
+                    self.gone(url)
+
+    def save(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as fptr:
+            json.dump({'changed': self.changed, 'added': self.added, 'removed': self.removed}, fptr, indent=4)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def load(path):
+        '''
+        :return: {'changed', 'added', 'removed'} lists of urls
+        '''
+        with open(path, encoding='utf-8') as fptr:
+            return json.load(fptr)
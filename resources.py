@@ -0,0 +1,80 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LoadTimes:
+    """
+    Seconds spent loading each component of the search stack. A load timed
+    inside another one (the link graph loaded by the adjacency matrix) keeps
+    its own row but only the outermost loads count towards the total.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.total = 0
+        self.lock = threading.Lock()
+        self.nesting = threading.local()
+
+    @contextmanager
+    def timed(self, name):
+        depth = getattr(self.nesting, 'depth', 0)
+        self.nesting.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.nesting.depth = depth
+            with self.lock:
+                self.times[name] = self.times.get(name, 0) + elapsed
+                if depth == 0:
+                    self.total += elapsed
+
+    def report(self):
+        with self.lock:
+            times = sorted(self.times.items(), key=lambda x: x[1], reverse=True)
+            total = self.total
+        width = max([len(name) for name, _ in times] + [len('total')])
+        lines = [f"{name:<{width}}  {seconds * 1000:10.1f} ms" for name, seconds in times]
+        lines.append(f"{'total':<{width}}  {total * 1000:10.1f} ms")
+        return "\n".join(lines)
+
+
+load_times = LoadTimes()
+
+
+class shared_resource:
+    """
+    Class attribute computed by the decorated function on first access.
+
+    The value is shared by every instance, like a plain class attribute, but
+    nothing is loaded at import time. Loading is thread safe so a background
+    warm-up and a request can race for it, and the time it takes is recorded
+    in load_times under the attribute's name.
+    """
+    missing = object()
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.name = loader.__name__
+        self.value = self.missing
+        self.lock = threading.Lock()
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if self.value is self.missing:
+            with self.lock:
+                if self.value is self.missing:
+                    with load_times.timed(f"{owner.__name__}.{self.name}"):
+                        self.value = self.loader(owner)
+        return self.value
+
+    def __set__(self, instance, value):
+        self.value = value
+
+    @property
+    def loaded(self):
+        return self.value is not self.missing
@@ -1,142 +1,544 @@
+import os
 import pickle
 import re
-from math import log
+import threading
 
 import h5py
-import nltk
-from nltk.tokenize import word_tokenize
-from scipy.spatial.distance import cdist
-from sentence_transformers import SentenceTransformer
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
+from scipy.sparse import csr_matrix
 
+from ann_index import ANN_INDEXES, unit_rows
+from cache import LRUCache
+from corpus import corpus_exists, iter_corpus, iter_documents, rewrite_corpus
+from fusion import fuse, scores_array, top_k
+from inverted_index import IndexBuilder, InvertedIndex
 from pageRank import TSPageRank
-from preprocessor import Preprocessor
-
-nltk.download('punkt')
+from refresh import Manifest
+from resources import load_times, shared_resource
 
 
 class SearchEngine:
-    model = SentenceTransformer('bert-base-nli-mean-tokens')
-    vectorizer = TfidfVectorizer()
-    document_lengths = {}
-    documents = []
     document_titles = {}
     urls = []
-    tf = {}
-    idf = {}
-    url_to_doc = {}
+    url_ids = {}
+    index = None
     document_embeddings = None
+    unit_embeddings = None
     document_embeddings_field2 = None
+    ann_index = None
+    neighbours = None
+    neighbour_distances = None
+    num_neighbours = 5
+    num_candidates = 100
+    num_expanded = 21
+    num_results = 100
+    fusion = 'rrf'
+    fusion_weights = {'lexical': 1, 'dense': 1, 'pagerank': 1}
+    pending_documents = {}
+    data_files = ['data/crawl', 'data/data.jsonl', 'data/data.pickle']
+    manifest_file = "data/manifest.json"
+    chunk_size = 1000
+    query_cache_size = 1024
+    result_cache_size = 256
     embeddings_file = f"data/bert_embeddings.h5"
-    preprocessor = Preprocessor(stemmer_flag=True, stopwords_flag=True, min_word_length=2)
+    neighbours_file = "data/bert_neighbours.h5"
+    ann_index_file = "data/bert_{}_index.h5"
+    index_dir = "data/tfidf_index"
+    legacy_tfidf_file = "data/tfidf_data.pickle"
+    pagerank = TSPageRank(num_iterations=50, tol=1e-6)
+
+    @shared_resource
+    def model(cls):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer('bert-base-nli-mean-tokens')
+
+    @shared_resource
+    def preprocessor(cls):
+        from preprocessor import Preprocessor
+        return Preprocessor(stemmer_flag=True, stopwords_flag=True, min_word_length=2)
 
-    pagerank = TSPageRank(num_iterations=4)
+    @shared_resource
+    def word_tokenize(cls):
+        import nltk
+        from nltk.tokenize import word_tokenize
+        try:
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            nltk.download('punkt')
+        return word_tokenize
 
     def clean_text(self, text: str):
         text = re.sub(r"[^a-zA-Z0-9 ]", " ", text)
         text = re.sub(r"\s+", " ", text)
         return text.strip()
 
-    def __init__(self, fresh_start=False):
-        self.import_data(fresh_start)
-        self.create_model(fresh_start)
+    def __init__(self, fresh_start=False, ann_method='exact', ann_params=None, data_file=None):
+        '''
+        :param fresh_start: rebuild the index and embeddings from the data file
+        :param ann_method: nearest neighbour search over the embeddings, one of
+        ann_index.ANN_INDEXES: 'exact' (brute force) or 'ivf' (approximate)
+        :param ann_params: keyword arguments of the ann index, e.g. {'n_probe': 8}
+        :param data_file: crawled pages, see corpus.iter_corpus. Defaults to the
+        first existing file of data_files
+        '''
+        if data_file is None:
+            data_file = next((path for path in self.data_files if corpus_exists(path)), self.data_files[-1])
+        self.data_file = data_file
+        self.query_embedding_cache = LRUCache(self.query_cache_size)
+        self.result_cache = LRUCache(self.result_cache_size)
+        self.ann_method = ann_method
+        self.ann_params = ann_params or {}
+        with load_times.timed('SearchEngine.import_data'):
+            self.import_data(fresh_start)
+        with load_times.timed('SearchEngine.create_model'):
+            self.create_model(fresh_start)
+
+    def warm_up(self, background=True):
+        '''
+        Load the resources that are otherwise loaded by the first search:
+        the BERT model, the nltk tokenizer and the link graph
+        :param background: load them in a daemon thread and return it
+        :return:
+        '''
+        def load():
+            self.word_tokenize
+            self.model
+            self.pagerank.link_graph
+            self.pagerank.adjacency
+
+        if not background:
+            load()
+            return None
+        thread = threading.Thread(target=load, name='search-engine-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def startup_report():
+        '''
+        :return: a table of the time each loaded component took to load
+        '''
+        return load_times.report()
+
+    def tokenize(self, text):
+        return self.word_tokenize(text)
+
+    def invalidate_caches(self, embeddings=True):
+        '''
+        Called whenever the index or the embeddings change
+        :param embeddings: also drop the cached query embeddings
+        :return:
+        '''
+        self.unit_embeddings = None
+        self.result_cache.clear()
+        if embeddings:
+            self.query_embedding_cache.clear()
+
+    def cache_stats(self):
+        return {"query_embeddings": self.query_embedding_cache.stats(),
+                "results": self.result_cache.stats()}
 
     def import_data(self, fresh_start):
-        data = pickle.load(open('data/data.pickle', 'rb'))
-        for url, text_dict in data.items():
-            self.urls.append(url)
-            document1 = text_dict['atext']
-            document2 = text_dict['body']
-            doc = "{} {}".format(document1, document2)
-            doc = self.clean_text(doc)
-            self.documents.append(document1)
-            self.url_to_doc[url] = document1
-            self.document_titles[url] = text_dict['title']
-            if fresh_start:
-                self.add_to_index(doc, url)
+        '''
+        Read the urls and titles of the data file chunk by chunk. On a fresh
+        start the pages are tokenised into the index builder as they are read,
+        so only one chunk of raw text is held in memory.
+        :param fresh_start:
+        :return:
+        '''
+        self.urls, self.url_ids, self.document_titles = [], {}, {}
+        self.pending_documents = {}
+        builder = IndexBuilder() if fresh_start else None
+        for chunk in iter_corpus(self.data_file, self.chunk_size):
+            for url, text_dict in chunk:
+                self.url_ids[url] = len(self.urls)
+                self.urls.append(url)
+                self.document_titles[url] = text_dict['title']
+                if fresh_start:
+                    doc = "{} {}".format(text_dict['atext'], text_dict['body'])
+                    builder.add_document(url, self.tokenize(self.clean_text(doc)))
         if fresh_start:
-            self.add_idf(N=len(data))
-            with open('data/tfidf_data.pickle', 'wb') as fptr:
-                pickle.dump([self.tf, self.idf, self.document_lengths], fptr)
+            self.index = builder.build()
+            self.index.save(self.index_dir)
         else:
-            with open('data/tfidf_data.pickle', 'rb') as fptr:
-                self.tf, self.idf, self.document_lengths = pickle.load(fptr)
+            self.read_index()
+            if self.index.urls != self.urls:
+                # the data file already holds a refresh crawl whose manifest is not applied yet,
+                # the doc ids are those of the index and the embeddings
+                self.urls = list(self.index.urls)
+                self.url_ids = {url: doc_id for doc_id, url in enumerate(self.urls)}
+        self.invalidate_caches()
+
+    def read_index(self):
+        if not InvertedIndex.exists(self.index_dir):
+            # convert an index pickled by an older version once
+            with open(self.legacy_tfidf_file, 'rb') as fptr:
+                tf, idf, document_lengths = pickle.load(fptr)
+            self.index = InvertedIndex.from_dicts(tf, idf, document_lengths, self.urls)
+            self.index.save(self.index_dir)
+            return
+        self.index = InvertedIndex.load(self.index_dir)
+
+    def add_document(self, url, title, atext, body):
+        self.add_documents([{'url': url, 'title': title, 'atext': atext, 'body': body}])
+
+    def add_documents(self, documents):
+        '''
+        Add new documents or replace the documents stored under the same urls,
+        without rebuilding the index. The embeddings are computed in one
+        batch, appended to the HDF5 store and searchable at once. The tf-idf
+        postings are staged and become searchable, with idf and document
+        lengths recomputed, at the next merge.
+        :param documents: iterable of {'url', 'title', 'atext', 'body'} dicts
+        :return:
+        '''
+        doc_ids, texts = [], []
+        for document in documents:
+            url = document['url']
+            if url not in self.url_ids:
+                self.url_ids[url] = len(self.urls)
+                self.urls.append(url)
+            doc_id = self.url_ids[url]
+            self.document_titles[url] = document['title']
+            doc = self.clean_text("{} {}".format(document['atext'], document['body']))
+            self.index.stage_document(doc_id, self.tokenize(doc))
+            self.pending_documents[url] = {"atext": document['atext'],
+                                           "body": document['body'],
+                                           "title": document['title']}
+            doc_ids.append(doc_id)
+            texts.append(document['atext'])
+        if doc_ids:
+            self.update_embeddings(doc_ids, texts)
+        self.invalidate_caches(embeddings=False)
+
+    def update_document(self, url, title, atext, body):
+        if url not in self.url_ids:
+            raise KeyError(f"{url} is not indexed")
+        self.add_document(url, title, atext, body)
+
+    def delete_document(self, url):
+        '''
+        The document is excluded from results at once and removed from the
+        index, embeddings and data at the next merge
+        :param url:
+        :return:
+        '''
+        if url not in self.url_ids:
+            raise KeyError(f"{url} is not indexed")
+        self.index.delete_document(self.url_ids[url])
+        self.pending_documents[url] = None
+        self.invalidate_caches(embeddings=False)
+
+    def merge(self):
+        '''
+        Apply the staged additions, updates and deletions: recompute idf and
+        document lengths, drop deleted documents and save the index,
+        embeddings, neighbours and data. Nothing is re-tokenised or re-encoded.
+        :return:
+        '''
+        if not self.index.has_changes and not self.pending_documents:
+            return
+        deleted = bool(self.index.deleted)
+        self.index, remap = self.index.merge(self.urls)
+        self.index.save(self.index_dir)
+        kept = np.flatnonzero(remap >= 0)
+        for doc_id in np.flatnonzero(remap < 0):
+            self.document_titles.pop(self.urls[doc_id], None)
+        self.urls = [self.urls[doc_id] for doc_id in kept]
+        self.url_ids = {url: doc_id for doc_id, url in enumerate(self.urls)}
+        self.document_embeddings = self.document_embeddings[kept]
+        self.invalidate_caches()
+        if deleted:
+            self.write_embeddings()
+        self.save_data()
+        self.create_ann_index()
+        self.create_neighbours()
+
+    def apply_manifest(self, manifest_file=None, source=None):
+        '''
+        Reindex only what a refresh crawl changed: the changed and added
+        pages are added or replaced, the removed ones deleted, then merged.
+        :param manifest_file: written by the refresh crawl, manifest_file by default
+        :param source: corpus with the refreshed pages, see corpus.iter_corpus. The data file by default,
+        which the Scrapy spider's refresh updates; crawler.py's refresh writes them to Crawler.data_file
+        :return: the manifest
+        '''
+        manifest = Manifest.load(manifest_file or self.manifest_file)
+        refreshed = set(manifest['changed']) | set(manifest['added'])
+        self.add_documents({'url': url, **text_dict}
+                           for url, text_dict in iter_documents(source or self.data_file) if url in refreshed)
+        for url in manifest['removed']:
+            if url in self.url_ids:
+                self.delete_document(url)
+        self.merge()
+        return manifest
+
+    def save_data(self):
+        rewrite_corpus(self.data_file, self.pending_documents)
+        self.pending_documents = {}
 
     def create_model(self, fresh_start):
-        if fresh_start:
+        if fresh_start or not self.embeddings_cover_index():
             self.create_embeddings()
         else:
             self.read_embeddings()
 
+    def embeddings_cover_index(self):
+        '''
+        :return: False if the embeddings file is missing or has fewer rows than
+        there are documents, e.g. after the spider's IndexPipeline indexed a crawl
+        '''
+        if not os.path.exists(self.embeddings_file):
+            return False
+        with h5py.File(self.embeddings_file, 'r') as h5f1:
+            return len(h5f1['dataset_1']) >= len(self.urls)
+
     def search(self, query, metric='cosine'):
-        qresults = []
-        query = self.clean_text(query)
-        qwords = word_tokenize(query.lower())
-        results = self.get_cosine(qwords)
-        query = self.clean_text(query.lower())
-        qembedding = self.model.encode(query)
-        qdistances = cdist([qembedding], self.document_embeddings, metric)[0]
-        bertresults = list(zip(self.urls, qdistances))
-        bertresults = sorted(bertresults, key=lambda x: x[1])
-        semantically_similar_docs = []
-        if len(results) > 10:
-            results = results[:10]
-        results += bertresults
-        temp = []
-        urls = []
-        for i in range(100):
-            if len(temp) > 20:
-                break
-            if results[i][0] not in urls:
-                urls.append(results[i][0])
-                temp.append(results[i])
-            if bertresults[i][0] not in urls:
-                urls.append(bertresults[i][0])
-                temp.append(bertresults[i])
-        results = temp
-        for url, score in results:
-            doc = self.url_to_doc[url]
-            doc = self.clean_text(doc.lower())
-            doc_embeddings = self.model.encode(doc)
-            distances = cdist([doc_embeddings], self.document_embeddings, "cosine")[0]
-            doc_results = list(zip(self.urls, distances))
-            doc_results = sorted(doc_results, key=lambda x: x[1])
-            for item in doc_results[:5]:
-                if item not in semantically_similar_docs:
-                    semantically_similar_docs.append(item)
-        results += self.get_pagerank(semantically_similar_docs)
-        for url, score in results:
-            title = self.document_titles[url]
-            qresults.append((title, url))
-        return qresults
-
-    def get_cosine(self, query_tokens):
-        query_length = 0
-        scores = {}
+        '''
+        Search one query, the same way as a batch of one in search_many
+        :param query:
+        :param metric: distance metric of the embedding search
+        :return: search results
+        '''
+        return self.search_many([query], metric)[0]
+
+    def encode_queries(self, queries):
+        '''
+        Embeddings of cleaned queries, the ones not in query_embedding_cache
+        are encoded in one batch
+        :param queries:
+        :return: list of embeddings
+        '''
+        qembeddings = [self.query_embedding_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(query for query, qembedding in zip(queries, qembeddings) if qembedding is None))
+        if missing:
+            encoded = dict(zip(missing, self.model.encode(missing)))
+            for query, qembedding in encoded.items():
+                self.query_embedding_cache.put(query, qembedding)
+            qembeddings = [encoded[query] if qembedding is None else qembedding
+                           for query, qembedding in zip(queries, qembeddings)]
+        return qembeddings
+
+    def search_many(self, queries, metric='cosine'):
+        '''
+        Search a batch of queries at once: the queries are encoded in one
+        model.encode call, the embedding distances are computed as one matrix
+        product and the tf-idf scores as one sparse matrix product.
+        :param queries: list of query strings
+        :param metric: distance metric of the embedding search
+        :return: list with the search results of every query
+        '''
+        queries = [self.clean_text(query) for query in queries]
+        qresults = {query: self.result_cache.get((query, metric)) for query in queries}
+        missing = [query for query, results in qresults.items() if results is None]
+        if missing:
+            lexical_results = self.score_queries([self.tokenize(query) for query in missing], k=self.num_candidates)
+            qembeddings = np.array(self.encode_queries(missing))
+            dense_results = self.ann_index.search_many(qembeddings, self.num_candidates + len(self.index.deleted),
+                                                       metric)
+            for query, lexical, dense in zip(missing, lexical_results, dense_results):
+                qresults[query] = self.fuse_results(lexical, self.dense_results(*dense))
+                self.result_cache.put((query, metric), qresults[query])
+        return [list(qresults[query]) for query in queries]
+
+    def dense_results(self, doc_ids, distances):
+        '''
+        :return: (doc_ids, similarities) of the num_candidates nearest documents that are not deleted
+        '''
+        if len(self.index.deleted):
+            live = ~np.isin(doc_ids, self.index.deleted_ids)
+            doc_ids, distances = doc_ids[live], distances[live]
+        return doc_ids[:self.num_candidates], -distances[:self.num_candidates]
+
+    def fuse_results(self, lexical, dense):
+        '''
+        Fuse the tf-idf, embedding and PageRank scores over dense arrays
+        indexed by doc id. The fused lexical and embedding scores pick the
+        num_expanded documents whose nearest neighbours are ranked with topic
+        specific PageRank, then all three signals are fused in one pass.
+        :param lexical: (doc_ids, tf-idf scores)
+        :param dense: (doc_ids, embedding similarities)
+        :return: [(title, url)] of the num_results best documents
+        '''
+        signals = {'lexical': scores_array(len(self.urls), *lexical),
+                   'dense': scores_array(len(self.urls), *dense)}
+        expanded = top_k(fuse(signals, self.fusion, self.fusion_weights), self.num_expanded)
+        neighbours = self.neighbours[expanded].ravel()
+        distances = self.neighbour_distances[expanded].ravel()
+        live = ~np.isin(neighbours, self.index.deleted_ids)
+        neighbours, distances = neighbours[live], distances[live]
+        if len(neighbours):
+            # the closest distance of every neighbour
+            order = np.lexsort((distances, neighbours))
+            first = np.concatenate([[True], neighbours[order][1:] != neighbours[order][:-1]])
+            neighbours, distances = neighbours[order][first], distances[order][first]
+            pgscores = self.get_pagerank([(self.urls[doc_id], float(distance))
+                                          for doc_id, distance in zip(neighbours, distances)])
+            # the push mode also ranks pages reached through the link graph
+            pgscores = [(self.url_ids[url], score) for url, score in pgscores if url in self.url_ids]
+            pg_ids = np.array([doc_id for doc_id, _ in pgscores], dtype=np.int64)
+            live = ~np.isin(pg_ids, self.index.deleted_ids)
+            signals['pagerank'] = scores_array(len(self.urls), pg_ids[live],
+                                               np.array([score for _, score in pgscores])[live])
+        best = top_k(fuse(signals, self.fusion, self.fusion_weights), self.num_results)
+        return [(self.document_titles[self.urls[doc_id]], self.urls[doc_id]) for doc_id in best]
+
+    def get_cosine(self, query_tokens, k=None):
+        '''
+        tf-idf cosine scores of the documents matching the query
+        :param query_tokens:
+        :param k: only return the k best documents. Documents that cannot make
+        the top k are skipped with max-score pruning, the result is the same as
+        the first k of the exhaustive ranking
+        :return: [(url, score)] sorted by decreasing score
+        '''
+        doc_ids, scores = self.score_query(query_tokens, k)
+        return [(self.index.urls[doc_id], float(score)) for doc_id, score in zip(doc_ids, scores)]
+
+    def score_query(self, query_tokens, k=None):
+        '''
+        :return: (doc_ids, scores) arrays of get_cosine
+        '''
+        qweights = self.query_weights(query_tokens)
+        query_length = sum(qtoken_tfidf ** 2 for _, qtoken_tfidf in qweights)
+        if k is None:
+            doc_ids = np.arange(self.index.num_docs)
+        else:
+            doc_ids = self.top_k_candidates(qweights, query_length, k)
+        scores = np.zeros(len(doc_ids))
+        for term_id, qtoken_tfidf in qweights:
+            matches, dtoken_tfidf = self.term_weights(term_id, doc_ids, exhaustive=k is None)
+            scores[matches] += qtoken_tfidf * dtoken_tfidf.astype(np.float64)
+        if k is None:
+            scores[self.index.deleted_ids] = 0
+        matched = np.flatnonzero(scores)
+        doc_ids = doc_ids[matched]
+        scores = self.normalize_score(doc_ids, scores[matched], query_length)
+        order = np.argsort(-scores, kind='stable')[:k]
+        return doc_ids[order], scores[order]
+
+    def term_weights(self, term_id, doc_ids, exhaustive=False):
+        '''
+        :param term_id:
+        :param doc_ids: sorted doc ids, all documents if exhaustive
+        :param exhaustive:
+        :return: positions in doc_ids of the documents containing the term and their weights
+        '''
+        posting_ids, weights = self.index.postings(term_id)
+        if exhaustive:
+            return posting_ids, weights
+        positions = np.searchsorted(posting_ids, doc_ids)
+        positions[positions == len(posting_ids)] = 0
+        found = np.flatnonzero(posting_ids[positions] == doc_ids) if len(posting_ids) else positions[:0]
+        return found, weights[positions[found]]
+
+    def top_k_candidates(self, qweights, query_length, k, tolerance=1e-9):
+        '''
+        Max-score pruning: terms are scored from the highest to the lowest
+        upper bound. Once the bounds of the remaining terms add up to less than
+        the current k-th best partial score, documents not seen so far cannot
+        reach the top k and the remaining (low idf, long) posting lists are
+        only probed for the documents already seen. Seen documents whose bound
+        falls below the threshold are dropped as well.
+        :param qweights: query_weights of the query
+        :param query_length:
+        :param k:
+        :param tolerance: relative slack on the bounds to absorb rounding errors
+        :return: sorted doc ids that contain every document of the top k
+        '''
+        if query_length == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64)
+        norm = np.sqrt(query_length)
+        bounds = [qtoken_tfidf * self.index.max_scores[term_id] / norm * (1 + tolerance)
+                  for term_id, qtoken_tfidf in qweights]
+        order = np.argsort(bounds)[::-1]
+        remaining = np.cumsum(np.array(bounds)[order][::-1])[::-1]
+        partial = np.zeros(self.index.num_docs)
+        candidates = None
+        threshold = 0
+        for i, position in enumerate(order):
+            term_id, qtoken_tfidf = qweights[position]
+            if candidates is None:
+                doc_ids, weights = self.index.postings(term_id)
+            else:
+                found, weights = self.term_weights(term_id, candidates)
+                doc_ids = candidates[found]
+            lengths = np.sqrt(query_length * self.index.doc_lengths[doc_ids].astype(np.float64))
+            partial[doc_ids] += qtoken_tfidf * weights.astype(np.float64) / lengths
+            partial[self.index.deleted_ids] = 0
+            later = remaining[i + 1] if i + 1 < len(remaining) else 0
+            seen = np.flatnonzero(partial) if candidates is None else candidates
+            if len(seen) >= k:
+                threshold = np.partition(partial[seen], len(seen) - k)[len(seen) - k] * (1 - tolerance)
+            if candidates is None and later < threshold:
+                candidates = seen
+            if candidates is not None:
+                candidates = candidates[partial[candidates] + later >= threshold]
+        if candidates is None:
+            candidates = np.flatnonzero(partial)
+        return candidates
+
+    def query_weights(self, query_tokens):
+        '''
+        :param query_tokens:
+        :return: (term_id, tfidf) of the indexed query terms, ordered by term id
+        '''
+        weights = []
         for token in set(query_tokens):
-            if token not in self.tf:
+            term_id = self.index.term_id(token)
+            if term_id is None:
                 continue
             qtoken_tf = query_tokens.count(token)
-            idf = self.idf[token]
-            qtoken_tfidf = qtoken_tf * idf
-            query_length += qtoken_tfidf ** 2
-            for doc_id, dtoken_tfidf in self.tf[token].items():
-                if doc_id not in scores:
-                    scores[doc_id] = 0
-                scores[doc_id] += qtoken_tfidf * dtoken_tfidf
-        scores = self.normalize_score(scores, query_length)
-        scores = sorted(scores, key=lambda x: x[1], reverse=True)
-        return scores
-
-    def normalize_score(self, scores, query_length):
-        normalized_scores = []
-        for doc_id, score in scores.items():
-            doc_length = self.document_lengths[doc_id]
-            score = score / ((query_length * doc_length) ** (1 / 2))
-            normalized_scores.append((doc_id, score))
-        return normalized_scores
-
-    def clean_text(self, text):
+            idf = float(self.index.idf[term_id])
+            weights.append((term_id, qtoken_tf * idf))
+        return sorted(weights)
+
+    def get_cosine_many(self, query_tokens_list, k=None):
+        '''
+        tf-idf cosine scores of several queries, computed as one product of a
+        sparse query-term matrix with the term-document postings matrix
+        :param query_tokens_list: list of token lists
+        :param k: only return the k best documents of every query
+        :return: list of [(url, score)] sorted by decreasing score
+        '''
+        return [[(self.index.urls[doc_id], float(score)) for doc_id, score in zip(doc_ids, scores)]
+                for doc_ids, scores in self.score_queries(query_tokens_list, k)]
+
+    def score_queries(self, query_tokens_list, k=None):
+        '''
+        :return: list of (doc_ids, scores) arrays of get_cosine_many
+        '''
+        rows, term_ids, weights = [], [], []
+        query_lengths = np.zeros(len(query_tokens_list))
+        for row, query_tokens in enumerate(query_tokens_list):
+            for term_id, qtoken_tfidf in self.query_weights(query_tokens):
+                query_lengths[row] += qtoken_tfidf ** 2
+                rows.append(row)
+                term_ids.append(term_id)
+                weights.append(qtoken_tfidf)
+        queries = csr_matrix((weights, (rows, term_ids)), shape=(len(query_tokens_list), self.index.num_terms))
+        scores = queries.dot(self.index.as_matrix()).tocsr()
+        scores.sort_indices()
+        results = []
+        for row in range(len(query_tokens_list)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            doc_ids = scores.indices[start:end]
+            row_scores = scores.data[start:end]
+            if len(self.index.deleted):
+                live = ~np.isin(doc_ids, self.index.deleted_ids)
+                doc_ids, row_scores = doc_ids[live], row_scores[live]
+            row_scores = self.normalize_score(doc_ids, row_scores, query_lengths[row])
+            order = np.argsort(-row_scores, kind='stable')[:k]
+            results.append((doc_ids[order], row_scores[order]))
+        return results
+
+    def normalize_score(self, doc_ids, scores, query_length):
+        if query_length == 0:
+            return scores[:0]
+        return scores / np.sqrt(query_length * self.index.doc_lengths[doc_ids])
+
+    @staticmethod
+    def clean_text(text):
         text = text.lower()
         text = re.sub(r'[^a-zA-Z0-9 ]', ' ', text)
         text = re.sub(r'\s+', ' ', text).strip()
@@ -144,34 +546,146 @@ class SearchEngine:
 
     def read_embeddings(self):
         h5f1 = h5py.File(self.embeddings_file, 'r')
-        self.document_embeddings = h5f1['dataset_1'][:]
+        # rows past the documents belong to additions that were never merged
+        self.document_embeddings = h5f1['dataset_1'][:len(self.urls)]
         h5f1.close()
+        self.invalidate_caches()
+        self.read_ann_index()
+        self.read_neighbours()
 
     def create_embeddings(self):
-        self.document_embeddings = self.model.encode(self.documents)
+        '''
+        Encode the anchor text of the pages one chunk of the data file at a
+        time, writing every chunk's rows at the doc ids of its pages. The doc
+        ids follow the index, whose order can differ from the data file's
+        after the spider's IndexPipeline built it.
+        :return:
+        '''
+        h5f1 = h5py.File(self.embeddings_file, 'w')
+        dataset = None
+        for chunk in iter_corpus(self.data_file, self.chunk_size):
+            # pages of a refresh whose manifest is not applied yet have no doc id
+            chunk = [(url, text_dict) for url, text_dict in chunk if url in self.url_ids]
+            if not chunk:
+                continue
+            embeddings = self.model.encode([text_dict['atext'] for _, text_dict in chunk])
+            if dataset is None:
+                dataset = h5f1.create_dataset('dataset_1', shape=(len(self.urls), embeddings.shape[1]),
+                                              dtype=embeddings.dtype, maxshape=(None, embeddings.shape[1]),
+                                              chunks=True)
+            doc_ids = np.array([self.url_ids[url] for url, _ in chunk])
+            order = np.argsort(doc_ids)
+            dataset[doc_ids[order].tolist()] = embeddings[order]
+        self.document_embeddings = dataset[:]
+        h5f1.close()
+        self.invalidate_caches()
+        self.create_ann_index()
+        self.create_neighbours()
+
+    def write_embeddings(self):
         h5f1 = h5py.File(self.embeddings_file, 'w')
-        h5f1.create_dataset('dataset_1', data=self.document_embeddings)
+        h5f1.create_dataset('dataset_1', data=self.document_embeddings,
+                            maxshape=(None, self.document_embeddings.shape[1]), chunks=True)
+        h5f1.close()
+
+    def update_embeddings(self, doc_ids, texts):
+        '''
+        Encode the documents, store their rows in memory and in the HDF5 file
+        (appending the rows of new documents) and compute their neighbours
+        :param doc_ids: ids of changed documents, new ids directly follow the current ones
+        :param texts: anchor text of the documents
+        :return:
+        '''
+        texts = dict(zip(doc_ids, texts))
+        doc_ids = np.array(sorted(texts), dtype=np.int64)
+        embeddings = self.model.encode([texts[doc_id] for doc_id in doc_ids])
+        new_rows = len(self.urls) - len(self.document_embeddings)
+        if new_rows:
+            self.document_embeddings = np.vstack(
+                [self.document_embeddings, np.zeros((new_rows, embeddings.shape[1]), dtype=embeddings.dtype)])
+        self.document_embeddings[doc_ids] = embeddings
+        self.invalidate_caches(embeddings=False)
+        h5f1 = h5py.File(self.embeddings_file, 'a')
+        dataset = h5f1['dataset_1']
+        if dataset.maxshape[0] is not None:
+            # files written before incremental updates have a fixed size
+            h5f1.close()
+            self.write_embeddings()
+        else:
+            dataset.resize(len(self.document_embeddings), axis=0)
+            dataset[doc_ids.tolist()] = embeddings
+            h5f1.close()
+        self.ann_index.update(self.document_embeddings, doc_ids)
+        neighbours, distances = self.nearest_documents(embeddings)
+        if new_rows:
+            self.neighbours = np.vstack([self.neighbours, np.zeros((new_rows, self.neighbours.shape[1]),
+                                                                   dtype=self.neighbours.dtype)])
+            self.neighbour_distances = np.vstack(
+                [self.neighbour_distances, np.zeros((new_rows, self.neighbour_distances.shape[1]),
+                                                    dtype=self.neighbour_distances.dtype)])
+        self.neighbours[doc_ids] = neighbours
+        self.neighbour_distances[doc_ids] = distances
+
+    def read_ann_index(self):
+        self.ann_index = ANN_INDEXES[self.ann_method](**self.ann_params)
+        try:
+            self.ann_index.load(self.ann_index_file.format(self.ann_method), self.document_embeddings)
+        except (OSError, KeyError, ValueError):
+            self.create_ann_index()
+
+    def create_ann_index(self):
+        self.ann_index = ANN_INDEXES[self.ann_method](**self.ann_params)
+        self.ann_index.build(self.document_embeddings)
+        self.ann_index.save(self.ann_index_file.format(self.ann_method))
+
+    def read_neighbours(self):
+        try:
+            h5f1 = h5py.File(self.neighbours_file, 'r')
+        except OSError:
+            self.create_neighbours()
+            return
+        self.neighbours = h5f1['neighbours'][:]
+        self.neighbour_distances = h5f1['distances'][:]
+        h5f1.close()
+        if len(self.neighbours) != len(self.document_embeddings):
+            self.create_neighbours()
+
+    def create_neighbours(self, block_size=1024):
+        '''
+        For every document store the ids and cosine distances of its
+        num_neighbours closest documents (itself included), so the search
+        expansion step is a lookup instead of an encode and a full scan.
+        :param block_size: number of documents compared against the corpus at once
+        :return:
+        '''
+        embeddings = self.document_embeddings
+        k = min(self.num_neighbours, len(embeddings))
+        self.neighbours = np.empty((len(embeddings), k), dtype=np.int32)
+        self.neighbour_distances = np.empty((len(embeddings), k), dtype=np.float32)
+        for start in range(0, len(embeddings), block_size):
+            neighbours, distances = self.nearest_documents(embeddings[start:start + block_size])
+            self.neighbours[start:start + block_size] = neighbours
+            self.neighbour_distances[start:start + block_size] = distances
+        h5f1 = h5py.File(self.neighbours_file, 'w')
+        h5f1.create_dataset('neighbours', data=self.neighbours)
+        h5f1.create_dataset('distances', data=self.neighbour_distances)
         h5f1.close()
 
-    def add_to_index(self, text, url):
-        words = word_tokenize(text)
-        for w in words:
-            if w not in self.tf:
-                self.tf[w] = {}
-            if url not in self.tf[w]:
-                self.tf[w][url] = 0
-            self.tf[w][url] += 1
-
-    def add_idf(self, N):
-        for w, doc in self.tf.items():
-            idf = log(N / len(doc))
-            self.idf[w] = idf
-            for url, tf in doc.items():
-                tfidf = tf * idf
-                self.tf[w][url] = tfidf
-                if url not in self.document_lengths:
-                    self.document_lengths[url] = 0
-                self.document_lengths[url] += tfidf ** 2
+    def nearest_documents(self, vectors):
+        '''
+        :param vectors: embeddings to look up
+        :return: ids and cosine distances of the num_neighbours closest documents of every vector
+        '''
+        if self.unit_embeddings is None:
+            self.unit_embeddings = unit_rows(np.asarray(self.document_embeddings, dtype=np.float32))
+        embeddings = self.unit_embeddings
+        vectors = unit_rows(np.asarray(vectors, dtype=np.float32))
+        k = min(self.num_neighbours, len(embeddings))
+        distances = 1 - vectors.dot(embeddings.T)
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1, kind='stable')
+        return np.take_along_axis(nearest, order, axis=1), np.take_along_axis(nearest_distances, order, axis=1)
 
     def get_pagerank(self, results):
         results = sorted(results, key=lambda x: x[1])